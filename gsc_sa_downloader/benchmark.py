@@ -0,0 +1,252 @@
+#       _                         __    __           __   __      __         __
+#      (_)___  ____  ____  __  __/ /_  / /___ ______/ /__/ /___ _/ /_  ___  / /
+#     / / __ \/ __ \/ __ \/ / / / __ \/ / __ `/ ___/ //_/ / __ `/ __ \/ _ \/ /
+#    / / /_/ / / / / / / / /_/ / /_/ / / /_/ / /__/ ,< / / /_/ / /_/ /  __/ /
+# __/ /\____/_/ /_/_/ /_/\__, /_.___/_/\__,_/\___/_/|_/_/\__,_/_.___/\___/_/
+#/___/                  /____/
+"""
+author: Johannes Kunze
+twitter: @jonnyblacklabel
+web: http://www.jonnyblacklabel.de/
+github: https://github.com/Jonnyblacklabel
+
+end-to-end throughput of download() against the local mock api
+
+every engine / sink combination runs in its own process with a fresh
+SQLITE_PATH, so peak rss and databases do not leak between runs.
+"""
+
+from multiprocessing import get_context
+from urllib.request import urlopen
+from mock_api import MockApi
+from loguru import logger
+import tempfile
+import json
+import time
+import sys
+import os
+
+
+ACCOUNT = 'benchmark'
+SITE = 'https://www.example.com/'
+
+
+def peak_rss_mb():
+  """peak resident memory of this process, None if unknown"""
+  try:
+    import resource
+  except ImportError: # windows
+    return None
+  rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  return rss / 1024 / (1024 if sys.platform == 'darwin' else 1)
+
+
+def api_stats(url):
+  with urlopen(url + 'stats') as response:
+    return json.loads(response.read())
+
+
+def check_rollback(sink_name: str):
+  """a batch written after a rolled back batch is committed
+
+  Args:
+    sink_name: name of sink in sinks.SINKS
+  """
+  import sinks
+  tbl_name = 'web_country_device_query'
+  row = lambda: dict(country='deu', device='DESKTOP', query='benchmark',
+                     date='2024-01-01', clicks=1, impressions=2, ctr=0.5,
+                     position=1.0, query_queue_id=1)
+  sink = sinks.get_sink(sink_name, 'rollback_check', SITE)
+  sink.open()
+  try:
+    for commit in [False, True]:
+      sink.begin()
+      sink.write(tbl_name, [row()])
+      sink.log(tbl_name, 1, '2024-01-01', 1, True)
+      if commit:
+        sink.commit()
+      else:
+        sink.rollback()
+  finally:
+    sink.close()
+  if not sink.logged().get(1, {}).get('finished'):
+    raise RuntimeError(f'[{sink_name}] write after rollback was not committed')
+
+
+def run(options, api_url, discovery_url, results):
+  """one benchmark run in a child process"""
+  logger.remove()
+  logger.add(sys.stderr, level='WARNING')
+  os.environ.update(SQLITE_PATH=options['path'],
+                    ROOT_DB='benchmark.db',
+                    MONTHS=str(options['months']),
+                    GSC_DISCOVERY_URL=discovery_url)
+  os.chdir(os.path.dirname(os.path.abspath(__file__))) # configurations
+  from google.oauth2.credentials import Credentials
+  import service_pool
+  service_pool.set_pool(ACCOUNT, service_pool.ServicePool(
+    ACCOUNT, credentials=Credentials(token='benchmark')))
+  import gsc_sa_downloader
+  import db
+  check_rollback(options['sink'])
+  gsc_sa_downloader.create_account_and_property(ACCOUNT, SITE)
+  before = api_stats(api_url)
+  start = time.time()
+  engines = gsc_sa_downloader.download(ACCOUNT, SITE,
+                                       qps=options['qps'],
+                                       site_qps=options['qps'],
+                                       max_workers=options['max_workers'],
+                                       engine=options['engine'],
+                                       sink=options['sink'],
+                                       stream=options['stream'],
+                                       batch=options['batch'],
+                                       pack=options['pack'])
+  elapsed = time.time() - start
+  after = api_stats(api_url)
+  row = db.con.query('SELECT COUNT(*) AS items, SUM(rows) AS rows '
+                     'FROM query_queue WHERE finished = 1').next()
+  writers = [engine.writer for engine in engines if engine.writer is not None]
+  results.put(dict(options,
+                   seconds=elapsed,
+                   items=row['items'],
+                   rows=row['rows'] or 0,
+                   calls=after['calls'] - before['calls'],
+                   throttled=after['throttled'] - before['throttled'],
+                   errors=after['errors'] - before['errors'],
+                   peak_rss_mb=peak_rss_mb(),
+                   lag_mean=max([w.mean_lag() for w in writers], default=0),
+                   lag_max=max([w.lag_max for w in writers], default=0)))
+
+
+def report(result):
+  seconds = max(result['seconds'], 1e-9)
+  result['items_s'] = result['items'] / seconds
+  result['rows_s'] = result['rows'] / seconds
+  result['calls_s'] = result['calls'] / seconds
+  rss = result['peak_rss_mb']
+  logger.info(f'[{result["engine"]}] [{result["sink"]}] [{result["max_workers"]} workers] '
+              f'- [{round(result["items_s"],2)}] items/s '
+              f'- [{round(result["rows_s"])}] rows/s '
+              f'- [{round(result["calls_s"],2)}] calls/s '
+              f'- [{"n/a" if rss is None else round(rss)}] MB peak rss '
+              f'- [{round(result["lag_mean"],3)}/{round(result["lag_max"],3)}] s writer lag mean/max '
+              f'- [{result["throttled"]}] throttled - [{result["errors"]}] errors')
+  return result
+
+
+def compare(results, baseline_path, tolerance):
+  """True if no run is slower than baseline by more than tolerance"""
+  with open(baseline_path) as f:
+    baseline = {(r['engine'], r['sink'], r['max_workers']): r for r in json.load(f)}
+  ok = True
+  for result in results:
+    base = baseline.get((result['engine'], result['sink'], result['max_workers']))
+    if base is None:
+      continue
+    for key in ['items_s', 'rows_s']:
+      if result[key] < base[key] * (1 - tolerance):
+        logger.warning(f'regression [{result["engine"]}] [{result["sink"]}] {key} '
+                       f'{round(result[key],2)} < {round(base[key],2)}')
+        ok = False
+  return ok
+
+
+def benchmark(engines=('threaded',), sinks=('sqlite',), max_workers=10,
+              months=1, qps=1000., stream=False, batch=0, pack=0, latency_ms=50,
+              error_rate=0., forbidden_rate=0., api_qps=None,
+              max_rows=100000, save=None, baseline=None, tolerance=0.1):
+  """run download() for every engine and sink against the mock api
+
+  Args:
+    engines: fetch engines (default: {('threaded',)})
+    sinks: sinks (default: {('sqlite',)})
+    max_workers: workers per engine (default: {10})
+    months: months of dates (default: {1})
+    qps: limiter qps of the downloader (default: {1000.})
+    stream: stream pages to the writer (default: {False})
+    batch: http batch size (default: {0})
+    pack: days per request of low volume jobs (default: {0})
+    latency_ms: mean api latency (default: {50})
+    error_rate: share of 429 answers (default: {0.})
+    forbidden_rate: share of 403 answers (default: {0.})
+    api_qps: qps per site of the api, more are answered with 429 (default: {None})
+    max_rows: rows of the biggest dimension combination per day (default: {100000})
+    save: write results as json to this file (default: {None})
+    baseline: results json to compare with (default: {None})
+    tolerance: allowed slowdown against baseline (default: {0.1})
+
+  Returns:
+    False if a run regressed against baseline
+    bool
+  """
+  api = MockApi(sites=[SITE], latency_ms=latency_ms, error_rate=error_rate,
+                forbidden_rate=forbidden_rate, qps=api_qps,
+                max_rows=max_rows).start()
+  context = get_context('spawn')
+  results = []
+  try:
+    for engine in engines:
+      for sink in sinks:
+        with tempfile.TemporaryDirectory() as path:
+          options = dict(engine=engine, sink=sink, max_workers=max_workers,
+                         months=months, qps=qps, stream=stream, batch=batch, pack=pack,
+                         path=path)
+          queue = context.Queue()
+          process = context.Process(target=run, args=(options, api.url,
+                                                      api.discovery_url, queue))
+          process.start()
+          process.join()
+          if process.exitcode != 0:
+            logger.error(f'[{engine}] [{sink}] failed - exit code {process.exitcode}')
+            continue
+          result = queue.get()
+          del result['path']
+          results.append(report(result))
+  finally:
+    api.stop()
+  if save:
+    with open(save, 'w') as f:
+      json.dump(results, f, indent=2)
+  if baseline:
+    return compare(results, baseline, tolerance)
+  return True
+
+
+def main():
+  from argparse import ArgumentParser
+  import sinks
+  parser = ArgumentParser(description='throughput benchmark against the local mock api')
+  parser.add_argument('--engines', nargs='+', default=['threaded'],
+                      choices=['threaded', 'async'])
+  parser.add_argument('--sinks', nargs='+', default=['sqlite'],
+                      choices=list(sinks.SINKS))
+  parser.add_argument('--max_workers', '-w', type=int, default=10)
+  parser.add_argument('--months', type=int, default=1,
+                      help='months of dates to download')
+  parser.add_argument('--qps', type=float, default=1000.,
+                      help='limiter qps of the downloader')
+  parser.add_argument('--stream', action='store_true')
+  parser.add_argument('--batch', '-b', type=int, default=0)
+  parser.add_argument('--pack', type=int, default=0,
+                      help='days per request of low volume jobs')
+  parser.add_argument('--latency_ms', type=float, default=50,
+                      help='mean latency of the mock api')
+  parser.add_argument('--error_rate', type=float, default=0.,
+                      help='share of 429 answers')
+  parser.add_argument('--forbidden_rate', type=float, default=0.,
+                      help='share of 403 quota exceeded answers')
+  parser.add_argument('--api_qps', type=float, default=None,
+                      help='qps per site of the mock api, more are answered with 429')
+  parser.add_argument('--max_rows', type=int, default=100000,
+                      help='rows of the biggest dimension combination per day')
+  parser.add_argument('--save', help='write results as json')
+  parser.add_argument('--baseline', help='results json to compare with, exit 1 on regression')
+  parser.add_argument('--tolerance', type=float, default=0.1,
+                      help='allowed slowdown against baseline')
+  args = parser.parse_args()
+  if not benchmark(**vars(args)):
+    sys.exit(1)
+
+if __name__ == '__main__':
+  main()
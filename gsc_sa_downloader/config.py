@@ -15,7 +15,6 @@ github: https://github.com/Jonnyblacklabel
 from configparser import ConfigParser
 from typing import List
 import itertools
-import time
 import os
 
 
@@ -95,10 +94,11 @@ def get_combinations_without_iterators():
 def get_combinations_with_iterators(client, iterator):
   combinations = list(itertools.product(get_searchtypes(),
                                         get_dimension_combinations()))
+  # values only depend on searchtype → one call per searchtype
+  client.prefetch_iterator_values(iterator, get_searchtypes())
   result = []
   for combination in combinations:
     values = client.get_iterator_values(iterator, combination[0])
-    time.sleep(1)
     filters = [(iterator,value,'equals', ) for value in values]
     for filter_ in filters:
       result.append(combination + (filter_, ))
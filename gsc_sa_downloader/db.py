@@ -12,20 +12,34 @@ github: https://github.com/Jonnyblacklabel
 """
 
 from sqlite3 import IntegrityError
+from sqlalchemy import text
 from loguru import logger
+from typing import List
 import dataset
 import dotenv
 import config
 import json
+import time
 import os
 
 
 dotenv.load_dotenv()
 
+QUERY_QUEUE_COLUMNS = {'seconds': 'FLOAT',
+                       'hits': 'INTEGER',
+                       'rps': 'FLOAT',
+                       'refresh': 'BOOLEAN NOT NULL DEFAULT 0',
+                       'claimed_by': 'TEXT',
+                       'lease_expires': 'FLOAT',
+                       'priority': 'INTEGER NOT NULL DEFAULT 0'}
+
+QUERY_QUEUE_STATUS = ('id', 'attempts', 'finished', 'rows', 'seconds', 'hits', 'rps')
+
 con = dataset.connect('sqlite:///'\
   +os.path.join(os.environ['SQLITE_PATH'],
                 os.environ['ROOT_DB']),
-  engine_kwargs=dict(connect_args={'check_same_thread':False}))
+  engine_kwargs=dict(connect_args={'check_same_thread':False,
+                                   'timeout':60})) # parallel downloads
 
 
 def init_gsc_properties():
@@ -33,13 +47,42 @@ def init_gsc_properties():
   con.query("""
     CREATE TABLE IF NOT EXISTS 'gsc_properties' (
     'id' INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT,
-    'account_name' TEXT NOT NULL UNIQUE,
-    'gsc_property' TEXT NOT NULL UNIQUE,
-    'active' BOOLEAN DEFAULT 1
+    'account_name' TEXT NOT NULL,
+    'gsc_property' TEXT NOT NULL,
+    'active' BOOLEAN DEFAULT 1,
+    UNIQUE ('account_name', 'gsc_property')
     );
     """)
 
 
+def rebuild_gsc_properties():
+  """allow many properties per account in an existing root db
+
+  older root dbs have unique account_name and gsc_property columns.
+  the table is copied to one with a unique (account_name, gsc_property),
+  ids stay the same.
+
+  Returns:
+    True if the table was rebuilt
+    bool
+  """
+  row = con.query("""
+    SELECT sql FROM sqlite_master
+    WHERE type = 'table' AND name = 'gsc_properties'
+    """).next()
+  if "UNIQUE ('account_name', 'gsc_property')" in row['sql']:
+    return False
+  with con as tx:
+    tx.query("ALTER TABLE 'gsc_properties' RENAME TO 'gsc_properties_old'")
+    init_gsc_properties()
+    tx.query("""
+      INSERT INTO 'gsc_properties' (id, account_name, gsc_property, active)
+      SELECT id, account_name, gsc_property, active FROM 'gsc_properties_old'
+      """)
+    tx.query("DROP TABLE 'gsc_properties_old'")
+  return True
+
+
 def drop_gsc_properties():
   """Drop table gsc_properties"""
   con.query("""
@@ -78,9 +121,34 @@ def init_query_queue():
     'attempts' INTEGER NOT NULL DEFAULT 0,
     'finished' BOOLEAN NOT NULL DEFAULT 0,
     'rows' INTEGER NOT NULL DEFAULT 0,
-    'streamed' BOOLEAN NOT NULL DEFAULT 0
+    'streamed' BOOLEAN NOT NULL DEFAULT 0,
+    'seconds' FLOAT,
+    'hits' INTEGER,
+    'rps' FLOAT,
+    'refresh' BOOLEAN NOT NULL DEFAULT 0,
+    'claimed_by' TEXT,
+    'lease_expires' FLOAT,
+    'priority' INTEGER NOT NULL DEFAULT 0
     );
     """)
+  add_columns('query_queue', QUERY_QUEUE_COLUMNS)
+  con.query("""
+    CREATE INDEX IF NOT EXISTS 'query_queue_claim'
+    ON 'query_queue' ('gsc_property_id', 'finished', 'priority')
+    """)
+
+
+def add_columns(table: str, columns: dict):
+  """add missing columns to existing table
+
+  Args:
+    table: table name
+    columns: column name → sqlite type
+  """
+  existing = [row['name'] for row in con.query(f"PRAGMA table_info('{table}')")]
+  for column, type_ in columns.items():
+    if column not in existing:
+      con.query(f"ALTER TABLE '{table}' ADD COLUMN '{column}' {type_}")
 
 
 def drop_query_queue():
@@ -332,6 +400,73 @@ def get_query_queue_items(gsc_property_id: int, gsc_property_job_id: int,
                                  **kwargs)
 
 
+def get_query_queue_dates(gsc_property_id: int):
+  """get dates in query queue per job of a property
+
+  Args:
+    gsc_property_id: id of gsc property
+
+  Returns:
+    job id → set of iso dates
+    dict
+  """
+  result = {}
+  rows = con.query("""
+    SELECT gsc_property_job_id, date
+    FROM query_queue
+    WHERE gsc_property_id = :gsc_property_id
+    """, gsc_property_id=gsc_property_id)
+  for row in rows:
+    result.setdefault(row['gsc_property_job_id'], set()).add(str(row['date']))
+  return result
+
+
+def get_job_max_rows(gsc_property_id: int):
+  """most rows of a fetched day per job of a property
+
+  items finished without api call (probed empty days) are left out.
+
+  Args:
+    gsc_property_id: id of gsc property
+
+  Returns:
+    job id → most rows of a day
+    dict
+  """
+  rows = con.query("""
+    SELECT gsc_property_job_id, MAX(rows) AS max_rows
+    FROM query_queue
+    WHERE gsc_property_id = :gsc_property_id
+      AND finished = 1 AND attempts > 0
+    GROUP BY gsc_property_job_id
+    """, gsc_property_id=gsc_property_id)
+  return {row['gsc_property_job_id']: row['max_rows'] for row in rows}
+
+
+def create_query_queue_items(items: List[dict]):
+  """insert many query queue items in one transaction
+
+  Args:
+    items: dicts with gsc_property_id, gsc_property_job_id, date
+           and optional finished, rows
+
+  Returns:
+    number of inserted items
+    int
+  """
+  if not items:
+    return 0
+  sql = text("""
+    INSERT INTO query_queue (gsc_property_id, gsc_property_job_id, date,
+                             finished, rows)
+    VALUES (:gsc_property_id, :gsc_property_job_id, :date, :finished, :rows)
+    """)
+  params = [dict(dict(finished=False, rows=0), **item) for item in items]
+  with con as tx:
+    tx.executable.execute(sql, params)
+  return len(items)
+
+
 def delete_query_queue_item(p_key: int):
   """delete item in query queue table
 
@@ -376,6 +511,167 @@ def update_query_queue_item(p_key: int, **kwargs):
   return con['query_queue'].upsert(row=data, keys=keys)
 
 
+def update_query_queue_items_status(statuses: List[tuple]):
+  """update status of many query queue items in one transaction
+
+  Args:
+    statuses: tuples of (id, attempts, finished, rows, seconds, hits, rps)
+
+  Returns:
+    number of updated items
+    int
+  """
+  if not statuses:
+    return 0
+  sql = text("""
+    UPDATE query_queue
+    SET attempts = :attempts, finished = :finished, rows = :rows,
+        seconds = :seconds, hits = :hits, rps = :rps, refresh = 0
+    WHERE id = :id
+    """)
+  params = [dict(zip(QUERY_QUEUE_STATUS, status)) for status in statuses]
+  with con as tx:
+    tx.executable.execute(sql, params)
+  return len(params)
+
+
+def refresh_query_queue_items(gsc_property_id: int, job_dates: dict):
+  """mark finished items of dates for a new download
+
+  items are unfinished again with refresh = 1, so their rows are
+  replaced by the next download.
+
+  Args:
+    gsc_property_id: id of gsc property
+    job_dates: job id → iso dates to refresh
+
+  Returns:
+    number of refreshed items
+    int
+  """
+  params = [dict(gsc_property_id=gsc_property_id,
+                 gsc_property_job_id=job_id,
+                 date=str(date))
+            for job_id, dates in job_dates.items() for date in dates]
+  if not params:
+    return 0
+  sql = text("""
+    UPDATE query_queue
+    SET finished = 0, attempts = 0, refresh = 1, priority = 1
+    WHERE gsc_property_id = :gsc_property_id
+      AND gsc_property_job_id = :gsc_property_job_id
+      AND date = :date
+      AND finished = 1
+    """)
+  with con as tx:
+    result = tx.executable.execute(sql, params)
+  return result.rowcount
+
+
+def get_query_queue_ids(gsc_property_id: int):
+  """ids of all query queue items of a property
+
+  Args:
+    gsc_property_id: id of gsc property
+
+  Returns:
+    ids of query queue items
+    set
+  """
+  rows = con.query("""
+    SELECT id FROM query_queue WHERE gsc_property_id = :gsc_property_id
+    """, gsc_property_id=gsc_property_id)
+  return {row['id'] for row in rows}
+
+
+def claim_query_queue_items(gsc_property_id: int, worker_id: str, limit: int,
+                            lease_seconds: float):
+  """claim unfinished items of active jobs for a worker
+
+  items without claim or with an expired lease (dead worker) are taken
+  in one update, highest priority first.
+
+  Args:
+    gsc_property_id: id of gsc property
+    worker_id: id of claiming worker (host:pid)
+    limit: max number of items
+    lease_seconds: seconds till the claim expires
+
+  Returns:
+    claimed query queue rows
+    list
+  """
+  now = time.time()
+  expires = now + lease_seconds
+  with con as tx:
+    tx.query("""
+      UPDATE query_queue
+      SET claimed_by = :worker_id, lease_expires = :expires
+      WHERE id IN (
+        SELECT id FROM query_queue
+        WHERE gsc_property_id = :gsc_property_id
+          AND finished = 0 AND attempts <= 5
+          AND (claimed_by IS NULL OR lease_expires < :now)
+          AND gsc_property_job_id IN (SELECT id FROM gsc_property_jobs
+                                      WHERE active = 1)
+        ORDER BY priority DESC, id
+        LIMIT :limit)
+      """, worker_id=worker_id, expires=expires, now=now,
+      gsc_property_id=gsc_property_id, limit=limit)
+    return list(tx.query("""
+      SELECT * FROM query_queue
+      WHERE claimed_by = :worker_id AND lease_expires = :expires
+        AND finished = 0
+      """, worker_id=worker_id, expires=expires))
+
+
+def renew_query_queue_leases(worker_id: str, ids: List[int],
+                             lease_seconds: float):
+  """extend leases of unfinished items claimed by worker
+
+  Args:
+    worker_id: id of claiming worker
+    ids: ids of query queue items
+    lease_seconds: seconds from now till the claims expire
+
+  Returns:
+    number of renewed items
+    int
+  """
+  if not ids:
+    return 0
+  expires = time.time() + lease_seconds
+  sql = text("""
+    UPDATE query_queue
+    SET lease_expires = :expires
+    WHERE id = :id AND claimed_by = :worker_id AND finished = 0
+    """)
+  with con as tx:
+    result = tx.executable.execute(sql, [dict(id=id_, worker_id=worker_id,
+                                              expires=expires)
+                                         for id_ in ids])
+  return result.rowcount
+
+
+def release_query_queue_items(worker_id: str):
+  """drop claims of worker on unfinished items
+
+  Args:
+    worker_id: id of claiming worker
+
+  Returns:
+    number of released items
+    int
+  """
+  with con as tx:
+    result = tx.executable.execute(text("""
+      UPDATE query_queue
+      SET claimed_by = NULL, lease_expires = NULL
+      WHERE claimed_by = :worker_id AND finished = 0
+      """), dict(worker_id=worker_id))
+  return result.rowcount
+
+
 def update_query_queue_items(gsc_property_id, gsc_property_job: int,
                              attempts: int, finished: bool, streamed: bool):
   """insert or update query queue items
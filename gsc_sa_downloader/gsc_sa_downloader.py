@@ -11,41 +11,130 @@ web: http://www.jonnyblacklabel.de/
 github: https://github.com/Jonnyblacklabel
 """
 
-from searchanalytics import Client, QueryThreaded
-from datetime import datetime
+from searchanalytics import Client, QueryThreaded, PAGE_WINDOW
+from searchanalytics_async import QueryAsync
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from lease import Lease
 from loguru import logger
 from typing import List
 from tqdm import tqdm
+import ratelimit
+import metrics
 import config
+import schema
+import sinks
 import json
 import time
 import sys
 import db
 import os
 
+
+ENGINES = {'threaded': QueryThreaded,
+           'async': QueryAsync}
+
+
 def generate_queries(client: Client, account_name: str,
-                     gsc_property: str, p_key: int, j_keys: List[int]):
+                     gsc_property: str, p_key: int, j_keys: List[int],
+                     refresh: int = 0, probe: bool = True):
+  """insert queue items for new dates of jobs
+
+  with probe, one date query per searchtype and filter finds the days
+  with data of filter jobs. their other days are inserted as finished
+  with 0 rows and never cost an api call.
+
+  Args:
+    client: client with web property
+    account_name: name of account
+    gsc_property: gsc property
+    p_key: id of gsc property
+    j_keys: ids of jobs
+    refresh: download the last n dates of every job again (default: {0})
+    probe: skip days without data of filter jobs (default: {True})
+  """
   db.init_query_queue()
-  length = 0
-  for j_key in tqdm(j_keys, desc='jobs'):
-    data = []
-    job = db.get_gsc_property_job(j_key)
+  dates_from_db = db.get_query_queue_dates(p_key)
+  jobs = [db.get_gsc_property_job(j_key) for j_key in j_keys]
+  if probe:
+    client.prefetch_date_lists({(job['searchtype'], job['filter'])
+                                for job in jobs if job['filter'] is not None})
+  data = []
+  n_empty = 0
+  refresh_dates = {}
+  for job in tqdm(jobs, desc='jobs'):
+    j_key = job['id']
     dates = client.get_date_list(gsc_property, searchtype=job['searchtype'])
-    dates = [datetime.strptime(date, '%Y-%m-%d').date() for date in dates]
-    dates_from_db = [row['date'] for row in
-                     db.get_query_queue_items(p_key, j_key)]
-    if len(dates_from_db) > 0:
-      dates = [x for x in dates if x not in dates_from_db]
-    for date in dates:
-      data.append(dict(gsc_property_id = p_key,
-                       gsc_property_job_id = j_key,
-                       date = date))
-    db.con['query_queue'].insert_many(data)
-    length += len(data)
-  logger.info(f'inserted {length} items in query_queue')
-
-
-def create_account_and_property(account_name, gsc_property, reset=False):
+    with_data = None
+    if probe and job['filter'] is not None:
+      with_data = set(client.get_date_list(gsc_property, searchtype=job['searchtype'],
+                                           filter_=job['filter']))
+    for date in sorted(set(dates) - dates_from_db.get(j_key, set())):
+      item = dict(gsc_property_id = p_key,
+                  gsc_property_job_id = j_key,
+                  date = date)
+      if with_data is not None and date not in with_data: # no data, no call
+        item.update(finished = True, rows = 0)
+        n_empty += 1
+      data.append(item)
+    if refresh > 0: # revised recent days
+      refresh_dates[j_key] = sorted(set(dates))[-refresh:]
+  db.create_query_queue_items(data) # one transaction for all jobs
+  logger.info(f'inserted {len(data)} items in query_queue - [{n_empty}] without data finished')
+  if refresh > 0:
+    n = db.refresh_query_queue_items(p_key, refresh_dates)
+    logger.info(f'refreshing {n} items of the last {refresh} days')
+
+
+def table_name(job):
+  """data table of job: searchtype_dimensions[_filter]"""
+  filter_ = json.loads(job['filter']) if job['filter'] is not None else None
+  return schema.table_name(job['searchtype'], json.loads(job['dimensions']), filter_)
+
+
+def get_property_queue_items(p_key: int):
+  """unfinished queue items of all active jobs of a property
+
+  Args:
+    p_key: id of gsc property
+
+  Returns:
+    items with tbl_name, query and job
+    list
+  """
+  queue = db.con['query_queue'].find(gsc_property_id = p_key,
+                                     finished = False,
+                                     attempts = {'<=': 5})
+  return queue_items(p_key, queue)
+
+
+def queue_items(p_key: int, rows):
+  """items with tbl_name, query and job for query queue rows of active jobs
+
+  Args:
+    p_key: id of gsc property
+    rows: query queue rows
+
+  Returns:
+    items with tbl_name, query and job
+    list
+  """
+  jobs = {job['id']: job for job in db.get_gsc_property_jobs(p_key, active=True)}
+  items = []
+  for item in rows:
+    job = jobs.get(item['gsc_property_job_id'])
+    if job is None: # inactive job
+      continue
+    try:
+      items.append(dict(tbl_name=table_name(job),
+                        query=item,
+                        job=job))
+    except Exception as e:
+      logger.error(f'error: {e}')
+  return items
+
+
+def create_account_and_property(account_name, gsc_property, reset=False,
+                                refresh=0, probe=True):
   """add or reset account with property
 
   (new) account with (new) property is inserted into database.
@@ -55,17 +144,19 @@ def create_account_and_property(account_name, gsc_property, reset=False):
     account_name: name of account (credentials filename)
     gsc_property: gsc property (with trailing slash)
     reset: delete data sqlite and delete row in root db (default: {False})
+    refresh: download the last n dates again (default: {0})
+    probe: skip days without data of filter jobs (default: {True})
   """
   client = Client(account_name = account_name)
   client.set_webproperty(gsc_property)
-  # löschen der daten sqlite des accounts
+  # löschen der daten des properties
   if reset:
-    try:
-      sqlite_data = os.path.join(os.environ['SQLITE_PATH'], account_name+'.db')
-      logger.info(f'deleting database {sqlite_data}.')
-      os.remove(sqlite_data)
-    except FileNotFoundError:
-      logger.info('no sqlite db found.')
+    for name, sink in sinks.SINKS.items():
+      try:
+        logger.info(f'deleting {name} data {sink.data_path(account_name, gsc_property)}.')
+        sink.delete(account_name, gsc_property)
+      except FileNotFoundError:
+        logger.info(f'no {name} data found.')
     try:
       gsc_property_id = db.get_gsc_property(account_name=account_name,
                                             gsc_property=gsc_property)['id']
@@ -112,24 +203,45 @@ def create_account_and_property(account_name, gsc_property, reset=False):
   logger.info('genereating daily queries in database.')
   # query jobs
   generate_queries(client, account_name, gsc_property,
-                   gsc_property_id, job_keys)
+                   gsc_property_id, job_keys, refresh=refresh, probe=probe)
 
-def download(account_name, gsc_property, generate=False, reset=False, max_workers=5):
+def download_property(account_name, gsc_property, generate=False, reset=False,
+                      max_workers=5, engine='threaded', sink='sqlite', stream=False,
+                      batch=0, refresh=0, no_probe=False, pack=0,
+                      page_window=PAGE_WINDOW, claim=0, lease=600, drop_ctr=False):
   """download gsc searchanalytics data
 
-  download gsc searchanalytics data for gsc property.
-  will create new jobs for property.
+  download gsc searchanalytics data for gsc property with the configured
+  rate limiters.
 
   Args:
     account_name: name of account (credentials filename)
     gsc_property: gsc property (with trailing slash)
     generate: if True, generate new queue items
     reset: delete data sqlite and delete row in root db (default: {False})
+    max_workers: number of worker threads (default: {5})
+    engine: threaded or async (default: {'threaded'})
+    sink: sqlite, sqlite_normalized or parquet (default: {'sqlite'})
+    stream: hand every api page to the writer right away (default: {False})
+    batch: group n small items into one http batch request (default: {0})
+    refresh: download the last n dates again and replace their rows (default: {0})
+    no_probe: queue every day of filter jobs, even without data (default: {False})
+    pack: fetch up to n days of low volume jobs in one request (default: {0})
+    page_window: api pages of one item fetched at once (default: {PAGE_WINDOW})
+    claim: claim n items at a time, so other processes can drain the same property (default: {0})
+    lease: seconds till claims of a dead process expire (default: {600})
+    drop_ctr: no ctr column in new tables, it is clicks / impressions (default: {False})
+
+  Returns:
+    engines of downloaded properties
+    list
   """
-  if generate or reset:
+  if generate or reset or refresh:
     create_account_and_property(account_name=account_name,
                                gsc_property=gsc_property,
-                               reset=reset)
+                               reset=reset,
+                               refresh=refresh,
+                               probe=not no_probe)
 
   logger.info(f'starting download for {account_name} with {gsc_property}.')
 
@@ -137,52 +249,135 @@ def download(account_name, gsc_property, generate=False, reset=False, max_worker
                                      gsc_property = gsc_property,
                                      active = True)
 
+  options = dict(account_name = account_name,
+                 max_workers = max_workers,
+                 sink = sink,
+                 stream = stream,
+                 batch_size = batch,
+                 pack_days = pack,
+                 page_window = page_window,
+                 keep_indices = claim > 0,
+                 drop_ctr = drop_ctr)
+  engines = []
   for property_ in tqdm(list(properties), desc='properties'):
-    jobs = db.get_gsc_property_jobs(property_['id'], active=True)
-
-
-    for job in tqdm(list(jobs), desc='jobs', leave=False):
-      queue = db.get_query_queue_items(property_['id'],
-                                       job['id'],
-                                       finished = False,
-                                       attempts = {'<=': 5})
-      thread_queue_items = []
-      for item in queue:
-        try:
-          table_name = job['searchtype'] + '_' + '_'.join(json.loads(job['dimensions']))
-          if job['filter'] is not None:
-            filter_ = json.loads(job['filter'])
-            table_name = '_'.join([table_name, filter_[1].lower()])
-          thread_queue_items.append(dict(tbl_name=table_name,
-                                         query=item,
-                                         job=job))
-        except Exception as e:
-          logger.error(f'error: {e}')
-
-      logger.info(f'starting threaded fetching - [max_workers {max_workers}]')
-      query_threaded = QueryThreaded(account_name = property_['account_name'],
-                                     gsc_property = property_['gsc_property'],
-                                     items = thread_queue_items,
-                                     max_workers = max_workers)
-      query_threaded.run()
-      logger.info('finished threaded fetching')
+    if claim > 0: # items are shared with other processes
+      engines.extend(download_claimed(property_, engine, claim, lease, options))
+      continue
+    # one pool for all jobs of the property
+    items = get_property_queue_items(property_['id'])
+    logger.info(f'starting {engine} fetching - [{len(items)}] items - [max_workers {max_workers}]')
+    query_threaded = ENGINES[engine](gsc_property = property_['gsc_property'],
+                                     items = items,
+                                     **options)
+    query_threaded.run()
+    engines.append(query_threaded)
+    logger.info(f'finished {engine} fetching')
 
   logger.info(f'finsihed download for {account_name} with {gsc_property}.')
+  return engines
 
-def download_all(generate=False, reset=False, max_workers=5):
-  """download gsc searchanalytics data for all properties
 
-  !!! ALL Databases are deleted and cleard if reset=True
+def download_claimed(property_, engine, claim, lease_seconds, options):
+  """download claimed items of a property till none are left
 
   Args:
-    reset: delete data sqlite and delete row in root db (default: {False})
+    property_: row of gsc property
+    engine: threaded or async
+    claim: items per claim
+    lease_seconds: seconds till claims expire without renewal
+    options: options of engine
+
+  Returns:
+    engines of claimed batches
+    list
   """
+  engines = []
+  lease = Lease(property_['id'], lease_seconds).start()
+  try:
+    while True:
+      items = queue_items(property_['id'], lease.claim(claim))
+      if not items:
+        break
+      logger.info(f'starting {engine} fetching - [{len(items)}] claimed items - [max_workers {options["max_workers"]}]')
+      query_threaded = ENGINES[engine](gsc_property = property_['gsc_property'],
+                                       items = items,
+                                       **options)
+      query_threaded.run()
+      engines.append(query_threaded)
+  finally:
+    lease.stop()
+  return engines
+
 
-  logger.info('starting download for all properties')
+def download(account_name, gsc_property, qps=None, burst=None, site_qps=None,
+             metrics_port=None, metrics_file=None, **kwargs):
+  """download gsc searchanalytics data
 
-  for row in db.con['gsc_properties'].all():
-    download(row['account_name'], row['gsc_property'], reset=reset)
+  download gsc searchanalytics data for gsc property.
+  will create new jobs for property.
 
+  Args:
+    account_name: name of account (credentials filename)
+    gsc_property: gsc property (with trailing slash)
+    qps: api calls per second for all workers (default: {env QPS or 20})
+    burst: token bucket size (default: {env BURST or qps})
+    site_qps: api calls per second for the property (default: {env SITE_QPS or 20})
+    metrics_port: serve prometheus metrics on this port (default: {env METRICS_PORT})
+    metrics_file: write json metrics snapshots to this file (default: {env METRICS_FILE})
+    kwargs: options of download_property
+
+  Returns:
+    engines of downloaded properties
+    list
+  """
+  ratelimit.configure(qps, burst, site_qps)
+  metrics.start(metrics_port, metrics_file)
+  try:
+    return download_property(account_name, gsc_property, **kwargs)
+  finally:
+    metrics.flush()
+
+
+def download_all(qps=None, burst=None, site_qps=None, parallel=1,
+                 metrics_port=None, metrics_file=None, **kwargs):
+  """download gsc searchanalytics data for all properties
+
+  !!! ALL Databases are deleted and cleard if reset=True
+
+  with parallel > 1 several properties are downloaded at once. all of
+  them share the project qps, every property gets an equal share of it
+  but never more than site_qps.
+
+  Args:
+    qps: api calls per second for the project (default: {env QPS or 20})
+    burst: token bucket size (default: {env BURST or qps})
+    site_qps: api calls per second per property (default: {env SITE_QPS or 20})
+    parallel: number of properties downloaded at once (default: {1})
+    metrics_port: serve prometheus metrics on this port (default: {env METRICS_PORT})
+    metrics_file: write json metrics snapshots to this file (default: {env METRICS_FILE})
+    kwargs: options of download_property
+  """
+  properties = list(db.con['gsc_properties'].all())
+  parallel = max(1, min(parallel, len(properties)))
+  project = ratelimit.configure(qps, burst)
+  site_qps = min(site_qps or float(os.environ.get('SITE_QPS', 20)),
+                 project.qps / parallel)
+  ratelimit.configure(project.qps, project.burst, site_qps)
+  metrics.start(metrics_port, metrics_file)
+
+  logger.info(f'starting download for all properties - [{parallel}] parallel - [{round(site_qps,3)}] qps per property')
+
+  with ThreadPoolExecutor(max_workers=parallel) as executor:
+    futures = {executor.submit(download_property, row['account_name'],
+                               row['gsc_property'], **kwargs): row
+               for row in properties}
+    for future in as_completed(futures):
+      try:
+        future.result()
+      except Exception as e:
+        logger.exception(f'{futures[future]["gsc_property"]} - {e}')
+
+  metrics.flush()
   logger.info('finished download for all properties')
 
 
@@ -199,6 +394,8 @@ def main():
   dl_all = subparsers.add_parser('download_all',
                                  help='generate queries & download')
   dl_all.set_defaults(func=download_all)
+  dl_all.add_argument('--parallel', '-p', type=int, default=1,
+                      help='number of properties downloaded at once, sharing --qps')
 
   dl = subparsers.add_parser('download',
                              help='create/generate queries & download for property of account')
@@ -208,7 +405,39 @@ def main():
     sp.add_argument('--generate', '-g', action='store_true',
                     help='generate queue items for new dates')
     sp.add_argument('--max_workers', '-w', type=int, default=10,
-                    help='number of max_workers')
+                    help='number of max_workers (threads or coroutines with --engine async)')
+    sp.add_argument('--qps', type=float, default=None,
+                    help='api calls per second for all workers (default env QPS or 20)')
+    sp.add_argument('--burst', type=int, default=None,
+                    help='token bucket size (default env BURST or qps)')
+    sp.add_argument('--site_qps', type=float, default=None,
+                    help='api calls per second per property (default env SITE_QPS or 20)')
+    sp.add_argument('--engine', '-e', choices=list(ENGINES), default='threaded',
+                    help='fetch engine, threads or asyncio (default threaded)')
+    sp.add_argument('--sink', '-s', choices=list(sinks.SINKS), default='sqlite',
+                    help='storage for rows (default sqlite)')
+    sp.add_argument('--stream', action='store_true',
+                    help='write every api page right away, memory bound by page size x workers')
+    sp.add_argument('--batch', '-b', type=int, default=0,
+                    help='group n small items (filter jobs, no page/query) into one http batch request')
+    sp.add_argument('--pack', type=int, default=0,
+                    help='fetch up to n days of low volume jobs in one request with date as dimension')
+    sp.add_argument('--page_window', type=int, default=PAGE_WINDOW,
+                    help=f'api pages of one big item fetched at once, 1 is sequential (default {PAGE_WINDOW})')
+    sp.add_argument('--claim', type=int, default=0,
+                    help='claim n items at a time, run several processes on one property (shared root db)')
+    sp.add_argument('--lease', type=float, default=600,
+                    help='seconds till claims of a dead process are taken by others (default 600)')
+    sp.add_argument('--refresh', type=int, default=0,
+                    help='download the last n days again and replace their rows (revised data)')
+    sp.add_argument('--drop_ctr', action='store_true',
+                    help='no ctr column in new tables, derive it as clicks / impressions')
+    sp.add_argument('--no_probe', action='store_true',
+                    help='queue every day of filter jobs, without probing days with data first')
+    sp.add_argument('--metrics_port', type=int, default=None,
+                    help='serve prometheus metrics on 127.0.0.1:port/metrics (default env METRICS_PORT)')
+    sp.add_argument('--metrics_file', default=None,
+                    help='write json metrics snapshots to file (default env METRICS_FILE)')
 
   ga = subparsers.add_parser('create-account',
                              help='create/generate queries for property of account')
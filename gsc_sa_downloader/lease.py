@@ -0,0 +1,90 @@
+#       _                         __    __           __   __      __         __
+#      (_)___  ____  ____  __  __/ /_  / /___ ______/ /__/ /___ _/ /_  ___  / /
+#     / / __ \/ __ \/ __ \/ / / / __ \/ / __ `/ ___/ //_/ / __ `/ __ \/ _ \/ /
+#    / / /_/ / / / / / / / /_/ / /_/ / / /_/ / /__/ ,< / / /_/ / /_/ /  __/ /
+# __/ /\____/_/ /_/_/ /_/\__, /_.___/_/\__,_/\___/_/|_/_/\__,_/_.___/\___/_/
+#/___/                  /____/
+"""
+author: Johannes Kunze
+twitter: @jonnyblacklabel
+web: http://www.jonnyblacklabel.de/
+github: https://github.com/Jonnyblacklabel
+
+claims on query queue items, so several processes (on one or more
+machines sharing the root db) can drain one property.
+"""
+
+from threading import Thread, Event
+from loguru import logger
+import socket
+import db
+import os
+
+
+def worker_id():
+  """host:pid of this process"""
+  return f'{socket.gethostname()}:{os.getpid()}'
+
+
+class Lease:
+  """claims of one worker on items of a property, renewed in the background
+
+  leases of the current claim are renewed every third of lease_seconds.
+  items of a dead worker are claimable again once its leases expire.
+
+  Args:
+    gsc_property_id: id of gsc property
+    lease_seconds: seconds till a claim expires without renewal (default: {600})
+    worker: id of worker (default: {host:pid})
+  """
+
+  def __init__(self, gsc_property_id: int, lease_seconds: float = 600,
+               worker: str = None):
+    self.gsc_property_id = gsc_property_id
+    self.lease_seconds = lease_seconds
+    self.worker = worker or worker_id()
+    self.ids = []
+    self.stopped = Event()
+    self.thread = None
+
+
+  def claim(self, limit: int):
+    """claim next items, leases of the previous claim are not renewed anymore
+
+    Args:
+      limit: max number of items
+
+    Returns:
+      claimed query queue rows
+      list
+    """
+    rows = db.claim_query_queue_items(self.gsc_property_id, self.worker,
+                                      limit, self.lease_seconds)
+    self.ids = [row['id'] for row in rows]
+    logger.info(f'[{self.worker}] claimed [{len(rows)}] items')
+    return rows
+
+
+  def renew(self):
+    while not self.stopped.wait(self.lease_seconds / 3):
+      try:
+        db.renew_query_queue_leases(self.worker, list(self.ids),
+                                    self.lease_seconds)
+      except Exception as e: # next renewal may succeed before expiry
+        logger.warning(f'[{self.worker}] lease renewal failed - {e}')
+
+
+  def start(self):
+    self.thread = Thread(target=self.renew, daemon=True)
+    self.thread.start()
+    return self
+
+
+  def stop(self):
+    """stop renewals and release unfinished claims"""
+    self.stopped.set()
+    if self.thread is not None:
+      self.thread.join()
+    released = db.release_query_queue_items(self.worker)
+    if released:
+      logger.info(f'[{self.worker}] released [{released}] unfinished items')
@@ -0,0 +1,334 @@
+#       _                         __    __           __   __      __         __
+#      (_)___  ____  ____  __  __/ /_  / /___ ______/ /__/ /___ _/ /_  ___  / /
+#     / / __ \/ __ \/ __ \/ / / / __ \/ / __ `/ ___/ //_/ / __ `/ __ \/ _ \/ /
+#    / / /_/ / / / / / / / /_/ / /_/ / / /_/ / /__/ ,< / / /_/ / /_/ /  __/ /
+# __/ /\____/_/ /_/_/ /_/\__, /_.___/_/\__,_/\___/_/|_/_/\__,_/_.___/\___/_/
+#/___/                  /____/
+"""
+author: Johannes Kunze
+twitter: @jonnyblacklabel
+web: http://www.jonnyblacklabel.de/
+github: https://github.com/Jonnyblacklabel
+
+process wide metrics of the download pipeline
+
+exposed as prometheus text on http://127.0.0.1:{port}/metrics and/or
+written as json snapshot to a file every few seconds.
+"""
+
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from threading import Thread, Lock, Event
+from loguru import logger
+import json
+import time
+import os
+
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+PAGE_BUCKETS = (1, 2, 3, 4, 5, 10, 20, 50, 100)
+ROW_BUCKETS = (100, 1000, 10000, 50000, 100000, 500000)
+
+
+class Metric:
+  """named metric with label values
+
+  Args:
+    name: metric name
+    help: description
+    labels: label names (default: {()})
+  """
+
+  type = 'untyped'
+
+  def __init__(self, name: str, help: str, labels=()):
+    self.name = name
+    self.help = help
+    self.labels = tuple(labels)
+    self.values = {}
+    self._lock = Lock()
+    REGISTRY.append(self)
+
+
+  def key(self, labels):
+    return tuple(str(labels.get(label, '')) for label in self.labels)
+
+
+  def label_text(self, key, extra=None):
+    pairs = list(zip(self.labels, key)) + ([extra] if extra else [])
+    if not pairs:
+      return ''
+    return '{' + ','.join(f'{k}="{v}"' for k, v in pairs) + '}'
+
+
+  def samples(self):
+    """(suffix, label text, value) for exposition"""
+    with self._lock:
+      return [('', self.label_text(key), value) for key, value in self.values.items()]
+
+
+  def snapshot(self):
+    with self._lock:
+      return {','.join(key): value for key, value in self.values.items()}
+
+
+class Counter(Metric):
+
+  type = 'counter'
+
+  def inc(self, n: float = 1, **labels):
+    key = self.key(labels)
+    with self._lock:
+      self.values[key] = self.values.get(key, 0) + n
+
+
+class Gauge(Metric):
+  """gauge, set directly or read from a callback on collection"""
+
+  type = 'gauge'
+
+  def __init__(self, name: str, help: str, labels=()):
+    super().__init__(name, help, labels)
+    self.callbacks = {}
+
+
+  def set(self, value: float, **labels):
+    with self._lock:
+      self.values[self.key(labels)] = value
+
+
+  def inc(self, n: float = 1, **labels):
+    key = self.key(labels)
+    with self._lock:
+      self.values[key] = self.values.get(key, 0) + n
+
+
+  def dec(self, n: float = 1, **labels):
+    self.inc(-n, **labels)
+
+
+  def track(self, callback, **labels):
+    """read value from callback on every collection"""
+    with self._lock:
+      self.callbacks[self.key(labels)] = callback
+
+
+  def remove(self, **labels):
+    key = self.key(labels)
+    with self._lock:
+      self.callbacks.pop(key, None)
+      self.values.pop(key, None)
+
+
+  def collect(self):
+    with self._lock:
+      callbacks = list(self.callbacks.items())
+    for key, callback in callbacks:
+      try:
+        value = callback()
+      except Exception: # source is gone
+        continue
+      with self._lock:
+        self.values[key] = value
+
+
+  def samples(self):
+    self.collect()
+    return super().samples()
+
+
+  def snapshot(self):
+    self.collect()
+    return super().snapshot()
+
+
+class Histogram(Metric):
+
+  type = 'histogram'
+
+  def __init__(self, name: str, help: str, labels=(), buckets=LATENCY_BUCKETS):
+    super().__init__(name, help, labels)
+    self.buckets = tuple(buckets)
+
+
+  def observe(self, value: float, **labels):
+    key = self.key(labels)
+    with self._lock:
+      counts, total, n = self.values.get(key, ([0] * len(self.buckets), 0., 0))
+      counts = [c + (value <= b) for c, b in zip(counts, self.buckets)]
+      self.values[key] = (counts, total + value, n + 1)
+
+
+  def samples(self):
+    result = []
+    with self._lock:
+      for key, (counts, total, n) in self.values.items():
+        for count, bucket in zip(counts, self.buckets):
+          result.append(('_bucket', self.label_text(key, ('le', bucket)), count))
+        result.append(('_bucket', self.label_text(key, ('le', '+Inf')), n))
+        result.append(('_sum', self.label_text(key), total))
+        result.append(('_count', self.label_text(key), n))
+    return result
+
+
+  def snapshot(self):
+    with self._lock:
+      return {','.join(key): dict(count=n, sum=total, mean=total / max(n, 1),
+                                  buckets=dict(zip(map(str, self.buckets), counts)))
+              for key, (counts, total, n) in self.values.items()}
+
+
+REGISTRY = []
+
+API_CALLS = Counter('gsc_api_calls_total', 'api calls by http status',
+                    ('site', 'method', 'status'))
+API_LATENCY = Histogram('gsc_api_call_seconds', 'latency of api calls',
+                        ('site', 'method'))
+API_ERRORS = Counter('gsc_api_errors_total', 'api errors by reason',
+                     ('site', 'reason'))
+ROWS = Counter('gsc_rows_total', 'rows fetched', ('site',))
+ITEMS = Counter('gsc_items_total', 'query queue items by result',
+                ('site', 'result'))
+PAGES = Histogram('gsc_item_pages', 'api pages per item (pagination depth)',
+                  ('site',), buckets=PAGE_BUCKETS)
+TASK_QUEUE = Gauge('gsc_task_queue_depth', 'items waiting for a worker', ('site',))
+DB_QUEUE = Gauge('gsc_db_queue_depth', 'messages waiting for the writer', ('site',))
+ACTIVE_WORKERS = Gauge('gsc_active_workers', 'workers fetching an item', ('site',))
+IN_FLIGHT = Gauge('gsc_in_flight', 'api requests in flight', ('site',))
+IN_FLIGHT_LIMIT = Gauge('gsc_in_flight_limit', 'adaptive limit of requests in flight',
+                        ('site',))
+COMMIT_SECONDS = Histogram('gsc_writer_commit_seconds', 'duration of sink commits',
+                           ('sink',))
+BATCH_SECONDS = Histogram('gsc_writer_batch_seconds',
+                          'first write of a batch till its commit', ('sink',))
+BATCH_ROWS = Histogram('gsc_writer_batch_rows', 'rows per commit', ('sink',),
+                       buckets=ROW_BUCKETS)
+WRITER_LAG = Histogram('gsc_writer_lag_seconds', 'queueing of a message till its commit',
+                       ('sink',))
+WRITER_ERRORS = Counter('gsc_writer_errors_total', 'failed writes and commits',
+                        ('sink',))
+
+
+def error_reason(status: int, content: str = ''):
+  """api error reason (rateLimitExceeded, ...) or http status"""
+  for reason in ('rateLimitExceeded', 'userRateLimitExceeded', 'quotaExceeded',
+                 'RESOURCE_EXHAUSTED', 'backendError', 'forbidden'):
+    if reason in content:
+      return reason
+  return f'http_{status}'
+
+
+def render():
+  """prometheus text exposition of all metrics"""
+  lines = []
+  for metric in REGISTRY:
+    lines.append(f'# HELP {metric.name} {metric.help}')
+    lines.append(f'# TYPE {metric.name} {metric.type}')
+    for suffix, labels, value in metric.samples():
+      lines.append(f'{metric.name}{suffix}{labels} {value}')
+  return '\n'.join(lines) + '\n'
+
+
+def snapshot():
+  """all metrics as dict"""
+  return dict(time=time.time(),
+              metrics={metric.name: metric.snapshot() for metric in REGISTRY})
+
+
+class Handler(BaseHTTPRequestHandler):
+
+  def log_message(self, format, *args):
+    pass
+
+
+  def do_GET(self):
+    if self.path.split('?')[0] not in ('/', '/metrics'):
+      self.send_response(404)
+      self.end_headers()
+      return
+    content = render().encode()
+    self.send_response(200)
+    self.send_header('Content-Type', 'text/plain; version=0.0.4')
+    self.send_header('Content-Length', str(len(content)))
+    self.end_headers()
+    self.wfile.write(content)
+
+
+class SnapshotWriter:
+  """write json snapshot to path every interval seconds
+
+  counters get a per_second rate since the previous snapshot.
+
+  Args:
+    path: json file
+    interval: seconds between snapshots (default: {10})
+  """
+
+  def __init__(self, path: str, interval: float = 10):
+    self.path = path
+    self.interval = interval
+    self.previous = None
+    self.stopped = Event()
+    self._lock = Lock()
+
+
+  def write(self):
+    with self._lock: # flush() and the snapshot thread
+      data = snapshot()
+      if self.previous is not None:
+        seconds = max(data['time'] - self.previous['time'], 1e-9)
+        data['per_second'] = {
+          metric.name: {key: (value - self.previous['metrics'][metric.name].get(key, 0)) / seconds
+                        for key, value in data['metrics'][metric.name].items()}
+          for metric in REGISTRY if isinstance(metric, Counter)}
+      self.previous = data
+      with open(self.path+'.tmp', 'w') as f:
+        json.dump(data, f, indent=2)
+      os.replace(self.path+'.tmp', self.path)
+
+
+  def run(self):
+    while not self.stopped.wait(self.interval):
+      try:
+        self.write()
+      except Exception as e:
+        logger.warning(f'metrics snapshot failed - {e}')
+    self.write()
+
+
+  def stop(self):
+    self.stopped.set()
+
+
+_server = None
+_snapshots = None
+_start_lock = Lock()
+
+
+def start(port: int = None, path: str = None, interval: float = None):
+  """start exporters once per process
+
+  Args:
+    port: serve prometheus text on this port (default: {env METRICS_PORT})
+    path: write json snapshots to this file (default: {env METRICS_FILE})
+    interval: seconds between snapshots (default: {env METRICS_INTERVAL or 10})
+  """
+  global _server, _snapshots
+  port = port or (int(os.environ['METRICS_PORT']) if 'METRICS_PORT' in os.environ else None)
+  path = path or os.environ.get('METRICS_FILE')
+  interval = interval or float(os.environ.get('METRICS_INTERVAL', 10))
+  with _start_lock:
+    if port and _server is None:
+      _server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+      _server.daemon_threads = True
+      Thread(target=_server.serve_forever, daemon=True).start()
+      logger.info(f'metrics on http://127.0.0.1:{port}/metrics')
+    if path and _snapshots is None:
+      _snapshots = SnapshotWriter(path, interval)
+      Thread(target=_snapshots.run, daemon=True).start()
+      logger.info(f'metrics snapshots to {path} every {interval} seconds')
+
+
+def flush():
+  """write a last json snapshot"""
+  if _snapshots is not None:
+    _snapshots.write()
@@ -0,0 +1,232 @@
+#       _                         __    __           __   __      __         __
+#      (_)___  ____  ____  __  __/ /_  / /___ ______/ /__/ /___ _/ /_  ___  / /
+#     / / __ \/ __ \/ __ \/ / / / __ \/ / __ `/ ___/ //_/ / __ `/ __ \/ _ \/ /
+#    / / /_/ / / / / / / / /_/ / /_/ / / /_/ / /__/ ,< / / /_/ / /_/ /  __/ /
+# __/ /\____/_/ /_/_/ /_/\__, /_.___/_/\__,_/\___/_/|_/_/\__,_/_.___/\___/_/
+#/___/                  /____/
+"""
+author: Johannes Kunze
+twitter: @jonnyblacklabel
+web: http://www.jonnyblacklabel.de/
+github: https://github.com/Jonnyblacklabel
+
+split data files of an account into one file per property
+
+rows are routed by query_queue_id to the property of their queue item.
+lookup tables (dim_*) of the normalized sink are copied to every file.
+the account file is renamed to *.migrated, not deleted.
+"""
+
+from sinks import SqliteSink, NormalizedSqliteSink, DuckDbSink, ParquetSink, LOG_TABLE
+from sinks import has_lookup_tables
+from loguru import logger
+import sqlite3
+import shutil
+import json
+import db
+import os
+
+
+def properties(account_name: str):
+  """gsc property id → gsc property of an account"""
+  return {row['id']: row['gsc_property']
+          for row in db.get_gsc_properties(account_name=account_name)}
+
+
+def root_path():
+  return os.path.join(os.environ['SQLITE_PATH'], os.environ['ROOT_DB'])
+
+
+def qualify(sql: str, schema: str):
+  """create statement in attached schema"""
+  for prefix in ['CREATE TABLE ', 'CREATE UNIQUE INDEX ', 'CREATE INDEX ']:
+    if sql.startswith(prefix):
+      return prefix + schema + '.' + sql[len(prefix):]
+  raise ValueError(sql)
+
+
+def split_sqlite(account_name: str, properties_: dict):
+  """split {SQLITE_PATH}/{account_name}.db
+
+  Returns:
+    rows per property file
+    dict
+  """
+  path = os.path.join(os.environ['SQLITE_PATH'], account_name+'.db')
+  if not os.path.exists(path) or os.path.samefile(path, root_path()):
+    return {}
+  con = sqlite3.connect(path, isolation_level=None)
+  con.execute('ATTACH DATABASE ? AS root', (root_path(),))
+  # files of the normalized sink have their own per property path
+  sink = NormalizedSqliteSink if has_lookup_tables(con) else SqliteSink
+  tables = con.execute("SELECT name, sql FROM sqlite_master WHERE type = 'table' "
+                       "AND name NOT LIKE 'sqlite_%'").fetchall()
+  indices = [row[0] for row in
+             con.execute("SELECT sql FROM sqlite_master WHERE type = 'index' "
+                         "AND sql IS NOT NULL").fetchall()]
+  result = {}
+  skipped = 0
+  for p_key, gsc_property in properties_.items():
+    target = sink.data_path(account_name, gsc_property)
+    if os.path.exists(target):
+      logger.warning(f'{target} exists, skipped')
+      skipped += 1
+      continue
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    con.execute('ATTACH DATABASE ? AS target', (target,))
+    con.execute('BEGIN')
+    n = 0
+    for name, sql in tables:
+      con.execute(qualify(sql, 'target'))
+      columns = {row[1] for row in con.execute(f'PRAGMA table_info("{name}")')}
+      if 'query_queue_id' in columns:
+        n += con.execute(f'INSERT INTO target."{name}" SELECT * FROM main."{name}" '
+                         'WHERE query_queue_id IN (SELECT id FROM root.query_queue '
+                         'WHERE gsc_property_id = ?)', (p_key,)).rowcount
+      else: # lookup tables
+        con.execute(f'INSERT INTO target."{name}" SELECT * FROM main."{name}"')
+    for sql in indices:
+      con.execute(qualify(sql, 'target'))
+    con.execute('COMMIT')
+    con.execute('DETACH DATABASE target')
+    logger.info(f'{target} - [{n}] rows')
+    result[target] = n
+  con.close()
+  if skipped: # rows of skipped properties are only in the account file
+    logger.warning(f'{path} kept, [{skipped}] properties not migrated')
+  else:
+    os.replace(path, path+'.migrated')
+  return result
+
+
+def split_duckdb(account_name: str, properties_: dict):
+  """split {SQLITE_PATH}/{account_name}.duckdb
+
+  Returns:
+    rows per property file
+    dict
+  """
+  path = os.path.join(os.environ['SQLITE_PATH'], account_name+'.duckdb')
+  if not os.path.exists(path):
+    return {}
+  import duckdb
+  import pyarrow
+  con = duckdb.connect(path)
+  tables = con.execute("SELECT table_name, sql FROM duckdb_tables() "
+                       "WHERE database_name = current_database()").fetchall()
+  result = {}
+  skipped = 0
+  for p_key, gsc_property in properties_.items():
+    target = DuckDbSink.data_path(account_name, gsc_property)
+    if os.path.exists(target):
+      logger.warning(f'{target} exists, skipped')
+      skipped += 1
+      continue
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    ids = pyarrow.table({'id': sorted(db.get_query_queue_ids(p_key))},
+                        schema=pyarrow.schema([('id', pyarrow.int64())]))
+    con.register('_ids', ids)
+    con.execute(f"ATTACH '{target}' AS target")
+    con.execute('BEGIN TRANSACTION')
+    n = 0
+    for name, sql in tables:
+      con.execute(qualify(sql, 'target'))
+      n += con.execute(f'INSERT INTO target."{name}" SELECT * FROM main."{name}" '
+                       'WHERE query_queue_id IN (SELECT id FROM _ids)').fetchone()[0]
+    con.execute('COMMIT')
+    con.execute('DETACH target')
+    con.unregister('_ids')
+    logger.info(f'{target} - [{n}] rows')
+    result[target] = n
+  con.close()
+  if skipped:
+    logger.warning(f'{path} kept, [{skipped}] properties not migrated')
+  else:
+    os.replace(path, path+'.migrated')
+  return result
+
+
+def split_parquet(account_name: str, properties_: dict):
+  """move parquet files of {PARQUET_PATH}/{account_name} into property folders
+
+  Returns:
+    files per property folder
+    dict
+  """
+  path = ParquetSink.account_path(account_name)
+  log_path = os.path.join(path, LOG_TABLE+'.jsonl')
+  if not os.path.exists(log_path):
+    return {}
+  targets = {p_key: ParquetSink.data_path(account_name, gsc_property)
+             for p_key, gsc_property in properties_.items()}
+  owner = {id_: p_key for p_key in properties_ for id_ in db.get_query_queue_ids(p_key)}
+  result = {target: 0 for target in targets.values()}
+  for tbl_name in os.listdir(path):
+    directory = os.path.join(path, tbl_name)
+    if not os.path.isdir(directory) or directory in targets.values():
+      continue
+    for root, dirs, files in os.walk(directory):
+      for name in files:
+        if not name.endswith('.parquet'):
+          continue
+        p_key = owner.get(int(name.split('-')[0]))
+        if p_key is None: # item of a deleted property
+          continue
+        target = os.path.join(targets[p_key], os.path.relpath(root, path))
+        os.makedirs(target, exist_ok=True)
+        os.replace(os.path.join(root, name), os.path.join(target, name))
+        result[targets[p_key]] += 1
+    if not any(files for root, dirs, files in os.walk(directory)):
+      shutil.rmtree(directory)
+  entries = {}
+  with open(log_path) as f:
+    for line in f:
+      try:
+        entry = json.loads(line)
+      except ValueError: # torn last line
+        continue
+      p_key = owner.get(entry['query_queue_id'])
+      if p_key is not None:
+        entries.setdefault(p_key, []).append(line)
+  for p_key, lines in entries.items():
+    os.makedirs(targets[p_key], exist_ok=True)
+    with open(os.path.join(targets[p_key], LOG_TABLE+'.jsonl'), 'a') as f:
+      f.writelines(lines)
+  os.replace(log_path, log_path+'.migrated')
+  for target, n in result.items():
+    logger.info(f'{target} - [{n}] files')
+  return result
+
+
+def migrate(account_names=None):
+  """split data files of accounts into one file per property
+
+  Args:
+    account_names: accounts to migrate (default: {all accounts in root db})
+  """
+  db.init_gsc_properties()
+  if db.rebuild_gsc_properties():
+    logger.info('gsc_properties allows many properties per account')
+  if not account_names:
+    account_names = sorted({row['account_name'] for row in db.get_gsc_properties()})
+  for account_name in account_names:
+    properties_ = properties(account_name)
+    if not properties_:
+      logger.warning(f'no properties of {account_name} in root db')
+      continue
+    logger.info(f'migrating {account_name} - [{len(properties_)}] properties')
+    split_sqlite(account_name, properties_)
+    split_duckdb(account_name, properties_)
+    split_parquet(account_name, properties_)
+
+
+def main():
+  from argparse import ArgumentParser
+  parser = ArgumentParser(description='split account data files into one file per property')
+  parser.add_argument('account_names', nargs='*',
+                      help='accounts to migrate (default all)')
+  args = parser.parse_args()
+  migrate(args.account_names)
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,422 @@
+#       _                         __    __           __   __      __         __
+#      (_)___  ____  ____  __  __/ /_  / /___ ______/ /__/ /___ _/ /_  ___  / /
+#     / / __ \/ __ \/ __ \/ / / / __ \/ / __ `/ ___/ //_/ / __ `/ __ \/ _ \/ /
+#    / / /_/ / / / / / / / /_/ / /_/ / / /_/ / /__/ ,< / / /_/ / /_/ /  __/ /
+# __/ /\____/_/ /_/_/ /_/\__, /_.___/_/\__,_/\___/_/|_/_/\__,_/_.___/\___/_/
+#/___/                  /____/
+"""
+author: Johannes Kunze
+twitter: @jonnyblacklabel
+web: http://www.jonnyblacklabel.de/
+github: https://github.com/Jonnyblacklabel
+
+local stand-in for the search console api (webmasters v3)
+
+serves the discovery document, sites.list, searchanalytics.query and
+batch requests. rows are synthetic but deterministic for every
+dimensions / searchtype / filter / date. point the downloader at it with
+
+  GSC_DISCOVERY_URL=http://127.0.0.1:8080/discovery/v1/apis/webmasters/v3/rest
+"""
+
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from googleapiclient import discovery_cache
+from email.parser import BytesParser
+from urllib.parse import unquote, urlparse
+from datetime import date, timedelta
+from threading import Thread, Lock
+from loguru import logger
+import random
+import json
+import time
+import zlib
+
+
+DISCOVERY_PATH = '/discovery/v1/apis/webmasters/v3/rest'
+ROW_LIMIT = 25000
+
+CARDINALITY = {'country': 240,
+               'device': 3,
+               'page': 5000,
+               'query': 80000,
+               'searchAppearance': 6}
+
+SEARCHTYPE_SHARE = {'web': 1.0,
+                    'image': 0.2,
+                    'video': 0.05,
+                    'news': 0.05,
+                    'discover': 0.05,
+                    'googleNews': 0.02}
+
+DEVICES = ['DESKTOP', 'MOBILE', 'TABLET']
+SEARCH_APPEARANCES = ['AMP_BLUE_LINK', 'AMP_TOP_STORIES', 'RICHCARD',
+                      'VIDEO', 'WEBLITE', 'JOB_LISTING']
+
+
+def checksum(*values):
+  return zlib.crc32('|'.join(map(str, values)).encode())
+
+
+class MockApi:
+  """search console api on a local http server
+
+  Args:
+    host: interface to bind (default: {'127.0.0.1'})
+    port: port, 0 picks a free one (default: {0})
+    sites: verified sites of the account (default: {('https://www.example.com/',)})
+    latency_ms: mean latency per request (default: {0})
+    error_rate: share of requests answered with 429 (default: {0.})
+    forbidden_rate: share of requests answered with 403 quota exceeded (default: {0.})
+    qps: requests per second per site, more are answered with 429 (default: {None})
+    max_rows: rows of the biggest dimension combination per day (default: {100000})
+    lag_days: days without data before today (default: {2})
+    seed: seed for latency and errors (default: {0})
+  """
+
+  def __init__(self, host: str = '127.0.0.1', port: int = 0,
+               sites=('https://www.example.com/',), latency_ms: float = 0,
+               error_rate: float = 0., forbidden_rate: float = 0.,
+               qps: float = None, max_rows: int = 100000, lag_days: int = 2,
+               seed: int = 0):
+    self.sites = list(sites)
+    self.latency_ms = latency_ms
+    self.error_rate = error_rate
+    self.forbidden_rate = forbidden_rate
+    self.qps = qps
+    self.max_rows = max_rows
+    self.lag_days = lag_days
+    self.random = random.Random(seed)
+    self.buckets = {}
+    self.stats = dict(calls=0, rows=0, throttled=0, errors=0, batches=0)
+    self._lock = Lock()
+    self.server = ThreadingHTTPServer((host, port), Handler)
+    self.server.daemon_threads = True
+    self.server.api = self
+    self.thread = None
+
+
+  @property
+  def url(self):
+    host, port = self.server.server_address[:2]
+    return f'http://{host}:{port}/'
+
+
+  @property
+  def discovery_url(self):
+    return self.url.rstrip('/') + DISCOVERY_PATH
+
+
+  def start(self):
+    self.thread = Thread(target=self.server.serve_forever, daemon=True)
+    self.thread.start()
+    logger.info(f'mock api on {self.url}')
+    return self
+
+
+  def stop(self):
+    self.server.shutdown()
+    self.server.server_close()
+
+
+  def snapshot(self):
+    with self._lock:
+      return dict(self.stats)
+
+
+  def count(self, key, n=1):
+    with self._lock:
+      self.stats[key] += n
+
+
+  def document(self):
+    """discovery document of google-api-python-client pointing to this server"""
+    document = json.loads(discovery_cache.get_static_doc('webmasters', 'v3'))
+    document['rootUrl'] = self.url
+    document['baseUrl'] = self.url + document['servicePath']
+    document.pop('mtlsRootUrl', None)
+    return document
+
+
+  def throttled(self, site):
+    """True if site is over qps"""
+    if not self.qps:
+      return False
+    with self._lock:
+      now = time.monotonic()
+      tokens, updated = self.buckets.get(site, (self.qps, now))
+      tokens = min(self.qps, tokens + (now - updated) * self.qps)
+      throttled = tokens < 1
+      self.buckets[site] = (tokens if throttled else tokens - 1, now)
+    return throttled
+
+
+  def delay(self):
+    if self.latency_ms:
+      with self._lock:
+        factor = self.random.uniform(0.5, 1.5)
+      time.sleep(self.latency_ms * factor / 1000)
+
+
+  def fault(self, site):
+    """simulated error for one call
+
+    Returns:
+      status, reason and message or None
+      tuple
+    """
+    if site not in self.sites:
+      return 403, 'forbidden', f"User does not have sufficient permission for site '{site}'."
+    if self.throttled(site):
+      self.count('throttled')
+      return 429, 'rateLimitExceeded', 'Search Analytics QPS quota exceeded.'
+    with self._lock:
+      draw = self.random.random()
+    if draw < self.error_rate:
+      self.count('errors')
+      return 429, 'rateLimitExceeded', 'Quota exceeded for quota metric.'
+    if draw < self.error_rate + self.forbidden_rate:
+      self.count('errors')
+      return 403, 'quotaExceeded', 'Search Analytics load quota exceeded.'
+    return None
+
+
+  def dates(self, start, end):
+    last = date.today() - timedelta(days=self.lag_days)
+    day = date.fromisoformat(start)
+    end = min(date.fromisoformat(end), last)
+    while day <= end:
+      yield day
+      day += timedelta(days=1)
+
+
+  def row_count(self, dimensions, searchtype, filters, day):
+    """rows of one day, scaled by searchtype and filter, jittered by date
+
+    unfiltered days have at least one row, about a third of the days
+    of a filter have none, the same days for every dimension.
+    """
+    if filters and checksum(day, searchtype, *sorted(filters.values())) % 3 == 0:
+      return 0
+    total = 1
+    for dimension in dimensions:
+      total *= CARDINALITY.get(dimension, 1)
+    total = min(total, self.max_rows) * SEARCHTYPE_SHARE.get(searchtype, 0.1)
+    total *= 0.1 ** len(filters)
+    jitter = 0.5 + checksum(day, searchtype, *dimensions) % 1000 / 2000
+    return max(1, int(total * jitter))
+
+
+  @staticmethod
+  def value(dimension, n, site, filters):
+    if dimension in filters:
+      return filters[dimension]
+    if dimension == 'country':
+      return ''.join(chr(97 + n // 26**i % 26) for i in range(3))
+    if dimension == 'device':
+      return DEVICES[n]
+    if dimension == 'page':
+      return f'{site}page-{n}'
+    if dimension == 'query':
+      return f'query {n}'
+    if dimension == 'searchAppearance':
+      return SEARCH_APPEARANCES[n]
+    return str(n)
+
+
+  def rows(self, site, body):
+    """rows of searchanalytics.query body"""
+    dimensions = body.get('dimensions', [])
+    searchtype = body.get('searchType', body.get('type', 'web'))
+    filters = {f['dimension']: f['expression']
+               for group in body.get('dimensionFilterGroups', [])
+               for f in group.get('filters', [])}
+    start_row = body.get('startRow', 0)
+    row_limit = min(body.get('rowLimit', 1000), ROW_LIMIT)
+    days = list(self.dates(body['startDate'], body['endDate']))
+    if 'date' in dimensions:
+      others = [d for d in dimensions if d != 'date']
+      counts = [(day, self.row_count(others, searchtype, filters, day))
+                for day in days]
+    else: # one aggregated day is enough for a synthetic answer
+      counts = [(days[0], self.row_count(dimensions, searchtype, filters, days[0]))] \
+               if days else []
+    rows = []
+    offset = 0
+    for day, count in counts:
+      if offset + count <= start_row:
+        offset += count
+        continue
+      for i in range(max(0, start_row - offset), count):
+        if len(rows) == row_limit:
+          return rows
+        keys = []
+        rest = i
+        for dimension in dimensions:
+          if dimension == 'date':
+            keys.append(day.isoformat())
+            continue
+          cardinality = CARDINALITY.get(dimension, 1)
+          keys.append(self.value(dimension, rest % cardinality, site, filters))
+          rest //= cardinality
+        # same metrics whether date is a dimension or the range is one day
+        h = checksum(site, searchtype, day,
+                     *[key for key, dimension in zip(keys, dimensions) if dimension != 'date'])
+        impressions = 1 + h % 1000
+        clicks = (h >> 10) % (impressions // 10 + 1)
+        rows.append(dict(keys=keys,
+                         clicks=clicks,
+                         impressions=impressions,
+                         ctr=clicks / impressions,
+                         position=1 + (h >> 20) % 1000 / 10))
+      offset += count
+    return rows
+
+
+  def query(self, site, body):
+    """searchanalytics.query
+
+    Returns:
+      http status and json response
+      tuple
+    """
+    self.count('calls')
+    self.delay()
+    fault = self.fault(site)
+    if fault is not None:
+      status, reason, message = fault
+      return status, dict(error=dict(code=status, message=message,
+                                     errors=[dict(domain='usageLimits',
+                                                  reason=reason,
+                                                  message=message)]))
+    rows = self.rows(site, body)
+    self.count('rows', len(rows))
+    response = dict(responseAggregationType='byProperty')
+    if rows:
+      response['rows'] = rows
+    return 200, response
+
+
+class Handler(BaseHTTPRequestHandler):
+
+  protocol_version = 'HTTP/1.1'
+
+  def log_message(self, format, *args):
+    pass
+
+
+  def send_json(self, status, data, headers=None):
+    content = json.dumps(data).encode()
+    self.send_response(status)
+    self.send_header('Content-Type', 'application/json; charset=UTF-8')
+    self.send_header('Content-Length', str(len(content)))
+    for key, value in (headers or {}).items():
+      self.send_header(key, value)
+    self.end_headers()
+    self.wfile.write(content)
+
+
+  def body(self):
+    return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+
+  def do_GET(self):
+    api = self.server.api
+    path = urlparse(self.path).path
+    if path == DISCOVERY_PATH:
+      self.send_json(200, api.document())
+    elif path == '/webmasters/v3/sites':
+      self.send_json(200, dict(siteEntry=[dict(siteUrl=site,
+                                               permissionLevel='siteOwner')
+                                          for site in api.sites]))
+    elif path == '/stats':
+      self.send_json(200, api.snapshot())
+    else:
+      self.send_json(404, dict(error=dict(code=404, message='not found')))
+
+
+  def do_POST(self):
+    api = self.server.api
+    path = urlparse(self.path).path
+    if path == '/batch/webmasters/v3':
+      self.batch(api, self.body())
+      return
+    site = self.site(path)
+    if site is None:
+      self.send_json(404, dict(error=dict(code=404, message='not found')))
+      return
+    status, response = api.query(site, json.loads(self.body() or b'{}'))
+    self.send_json(status, response,
+                   headers={'Retry-After': '1'} if status == 429 else None)
+
+
+  @staticmethod
+  def site(path):
+    prefix, suffix = '/webmasters/v3/sites/', '/searchAnalytics/query'
+    if path.startswith(prefix) and path.endswith(suffix):
+      return unquote(path[len(prefix):-len(suffix)])
+    return None
+
+
+  def batch(self, api, content):
+    """multipart/mixed batch of searchanalytics.query requests"""
+    api.count('batches')
+    header = f'Content-Type: {self.headers["Content-Type"]}\r\n\r\n'.encode()
+    message = BytesParser().parsebytes(header + content)
+    boundary = 'batch_mock_boundary'
+    parts = []
+    for part in message.get_payload():
+      request = part.get_payload()
+      request_line, rest = request.replace('\r\n', '\n').split('\n', 1)
+      body = rest.split('\n\n', 1)[1] if '\n\n' in rest else ''
+      site = self.site(urlparse(request_line.split(' ')[1]).path)
+      if site is None:
+        status, response = 404, dict(error=dict(code=404, message='not found'))
+      else:
+        status, response = api.query(site, json.loads(body or '{}'))
+      content_id = part['Content-ID'].replace('<', '<response-', 1)
+      payload = json.dumps(response)
+      parts.append(f'--{boundary}\r\n'
+                   'Content-Type: application/http\r\n'
+                   f'Content-ID: {content_id}\r\n\r\n'
+                   f'HTTP/1.1 {status} {"OK" if status == 200 else "Error"}\r\n'
+                   'Content-Type: application/json; charset=UTF-8\r\n'
+                   + ('Retry-After: 1\r\n' if status == 429 else '') +
+                   f'Content-Length: {len(payload)}\r\n\r\n'
+                   f'{payload}\r\n')
+    content = (''.join(parts) + f'--{boundary}--\r\n').encode()
+    self.send_response(200)
+    self.send_header('Content-Type', f'multipart/mixed; boundary={boundary}')
+    self.send_header('Content-Length', str(len(content)))
+    self.end_headers()
+    self.wfile.write(content)
+
+
+def main():
+  from argparse import ArgumentParser
+  parser = ArgumentParser(description='local search console api for tests and benchmarks')
+  parser.add_argument('--host', default='127.0.0.1')
+  parser.add_argument('--port', type=int, default=8080)
+  parser.add_argument('--site', action='append', dest='sites',
+                      help='verified site, can be repeated (default https://www.example.com/)')
+  parser.add_argument('--latency_ms', type=float, default=0,
+                      help='mean latency per request')
+  parser.add_argument('--error_rate', type=float, default=0.,
+                      help='share of requests answered with 429')
+  parser.add_argument('--forbidden_rate', type=float, default=0.,
+                      help='share of requests answered with 403 quota exceeded')
+  parser.add_argument('--qps', type=float, default=None,
+                      help='requests per second per site, more are answered with 429')
+  parser.add_argument('--max_rows', type=int, default=100000,
+                      help='rows of the biggest dimension combination per day')
+  args = parser.parse_args()
+  kwargs = vars(args)
+  kwargs['sites'] = kwargs['sites'] or ['https://www.example.com/']
+  api = MockApi(**kwargs)
+  logger.info(f'GSC_DISCOVERY_URL={api.discovery_url}')
+  try:
+    api.server.serve_forever()
+  except KeyboardInterrupt:
+    api.server.server_close()
+
+if __name__ == '__main__':
+  main()
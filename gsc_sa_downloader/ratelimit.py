@@ -0,0 +1,348 @@
+#       _                         __    __           __   __      __         __
+#      (_)___  ____  ____  __  __/ /_  / /___ ______/ /__/ /___ _/ /_  ___  / /
+#     / / __ \/ __ \/ __ \/ / / / __ \/ / __ `/ ___/ //_/ / __ `/ __ \/ _ \/ /
+#    / / /_/ / / / / / / / /_/ / /_/ / / /_/ / /__/ ,< / / /_/ / /_/ /  __/ /
+# __/ /\____/_/ /_/_/ /_/\__, /_.___/_/\__,_/\___/_/|_/_/\__,_/_.___/\___/_/
+#/___/                  /____/
+"""
+author: Johannes Kunze
+twitter: @jonnyblacklabel
+web: http://www.jonnyblacklabel.de/
+github: https://github.com/Jonnyblacklabel
+"""
+
+from threading import Condition, Lock, RLock, local
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+import asyncio
+import time
+import os
+
+
+RATE_LIMIT_REASONS = ('rateLimitExceeded', 'userRateLimitExceeded',
+                      'quotaExceeded', 'RESOURCE_EXHAUSTED')
+
+
+def is_congestion(status: int, content: str = ''):
+  """True if response means the api is overloaded (429, 5xx, quota 403)"""
+  if status == 429 or status >= 500:
+    return True
+  return status == 403 and any(reason in content for reason in RATE_LIMIT_REASONS)
+
+
+def parse_retry_after(value):
+  """seconds of a Retry-After header (seconds or http date), None if missing"""
+  if not value:
+    return None
+  try:
+    return max(0., float(value))
+  except ValueError:
+    pass
+  try:
+    return max(0., (parsedate_to_datetime(value)
+                    - datetime.now(timezone.utc)).total_seconds())
+  except (TypeError, ValueError):
+    return None
+
+
+class TokenBucket:
+  """process wide token bucket
+
+  every api call takes one token. tokens are refilled with qps per second
+  up to burst. callers that find the bucket empty reserve a token in the
+  future and sleep until it is due, so concurrent callers are paced in
+  the order they arrived.
+
+  Args:
+    qps: tokens per second
+    burst: size of the bucket (default: {qps})
+  """
+
+  def __init__(self, qps: float, burst: int = None):
+    self.qps = float(qps)
+    self.burst = burst or max(1, int(qps))
+    self.tokens = float(self.burst)
+    self.updated = time.monotonic()
+    self.calls = 0
+    self.started = time.monotonic()
+    self._lock = Lock()
+    self._local = local()
+
+
+  def reserve(self, n: int = 1):
+    """take n tokens
+
+    Args:
+      n: number of tokens (default: {1})
+
+    Returns:
+      seconds to wait till tokens are available
+      float
+    """
+    with self._lock:
+      now = time.monotonic()
+      self.tokens = min(self.burst,
+                        self.tokens + (now - self.updated) * self.qps)
+      self.updated = now
+      self.tokens -= n
+      self.calls += n
+      wait = max(0, -self.tokens / self.qps)
+    self._local.calls = self.thread_calls() + n
+    return wait
+
+
+  def acquire(self, n: int = 1):
+    """block till n tokens are available
+
+    Args:
+      n: number of tokens (default: {1})
+
+    Returns:
+      seconds waited
+      float
+    """
+    wait = self.reserve(n)
+    if wait > 0:
+      time.sleep(wait)
+    return wait
+
+
+  async def acquire_async(self, n: int = 1):
+    """wait for n tokens without blocking the event loop
+
+    Args:
+      n: number of tokens (default: {1})
+
+    Returns:
+      seconds waited
+      float
+    """
+    wait = self.reserve(n)
+    if wait > 0:
+      await asyncio.sleep(wait)
+    return wait
+
+
+  def thread_calls(self):
+    """number of tokens taken by the current thread"""
+    return getattr(self._local, 'calls', 0)
+
+
+  def mean_rps(self):
+    """mean calls per second since creation"""
+    return self.calls / max(time.monotonic() - self.started, 1e-9)
+
+
+class AimdController:
+  """adaptive limit of requests in flight (additive increase, multiplicative decrease)
+
+  the limit starts small and grows by one per success (slow start) until
+  the first congestion, then by one per limit successes. successes with
+  a latency above latency_factor x the lowest latency seen do not raise
+  the limit. a congestion (429, 5xx, quota 403) cuts the limit by
+  decrease, at most once per window, and pauses all callers for
+  Retry-After seconds or an exponential backoff.
+
+  Args:
+    initial: start limit (default: {2})
+    minimum: lowest limit (default: {1})
+    maximum: highest limit (default: {1000})
+    decrease: factor for a cut (default: {0.5})
+    latency_factor: healthy latency relative to the lowest (default: {3.})
+  """
+
+  def __init__(self, initial: int = 2, minimum: int = 1, maximum: int = 1000,
+               decrease: float = 0.5, latency_factor: float = 3.):
+    self.limit = float(initial)
+    self.minimum = minimum
+    self.maximum = maximum
+    self.decrease = decrease
+    self.latency_factor = latency_factor
+    self.in_flight = 0
+    self.slow_start = True
+    self.min_latency = None
+    self.backoff = 1.
+    self.paused_until = 0.
+    self.last_cut = 0.
+    self.cuts = 0
+    self._cond = Condition()
+
+
+  def try_acquire(self):
+    """take a slot if possible
+
+    Returns:
+      0 if a slot was taken, else seconds to wait before trying again
+      float
+    """
+    with self._cond:
+      pause = self.paused_until - time.monotonic()
+      if pause > 0:
+        return pause
+      if self.in_flight < int(self.limit):
+        self.in_flight += 1
+        return 0.
+      return 0.01
+
+
+  def acquire(self):
+    """block till a slot is free and no pause is active"""
+    with self._cond:
+      while True:
+        pause = self.paused_until - time.monotonic()
+        if pause > 0:
+          self._cond.wait(pause)
+        elif self.in_flight < int(self.limit):
+          self.in_flight += 1
+          return
+        else:
+          self._cond.wait()
+
+
+  async def acquire_async(self):
+    """wait for a slot without blocking the event loop"""
+    while True:
+      wait = self.try_acquire()
+      if wait == 0:
+        return
+      await asyncio.sleep(wait)
+
+
+  def release(self, latency: float = None, congested: bool = False,
+              retry_after: float = None):
+    """free a slot and adapt the limit
+
+    Args:
+      latency: seconds of the request, None leaves the limit as it is (default: {None})
+      congested: request was throttled by the api (default: {False})
+      retry_after: seconds from Retry-After header (default: {None})
+    """
+    with self._cond:
+      self.in_flight -= 1
+      if congested:
+        self.congestion(retry_after)
+      elif latency is not None:
+        self.success(latency)
+      self._cond.notify_all()
+
+
+  def success(self, latency):
+    self.backoff = 1.
+    if self.min_latency is None or latency < self.min_latency:
+      self.min_latency = latency
+    if latency > self.latency_factor * self.min_latency: # slow, hold
+      self.slow_start = False
+      return
+    self.limit += 1 if self.slow_start else 1 / self.limit
+    self.limit = min(self.limit, self.maximum)
+
+
+  def congestion(self, retry_after=None):
+    now = time.monotonic()
+    self.slow_start = False
+    window = max(self.min_latency or 0, 1.) # one cut per round trip
+    if now - self.last_cut > window:
+      self.limit = max(self.minimum, self.limit * self.decrease)
+      self.last_cut = now
+      self.cuts += 1
+    pause = retry_after if retry_after is not None else self.backoff
+    self.backoff = min(self.backoff * 2, 60.)
+    self.paused_until = max(self.paused_until, now + pause)
+
+
+class SiteLimiter:
+  """limiter for one site: takes a token from the site and the project bucket
+
+  controller limits the requests in flight for the site.
+
+  Args:
+    site: site bucket
+    project: project bucket
+  """
+
+  def __init__(self, site: TokenBucket, project: TokenBucket):
+    self.site = site
+    self.project = project
+    self.controller = AimdController()
+
+
+  def reserve(self, n: int = 1):
+    return max(self.site.reserve(n), self.project.reserve(n))
+
+
+  def acquire(self, n: int = 1):
+    wait = self.reserve(n)
+    if wait > 0:
+      time.sleep(wait)
+    return wait
+
+
+  async def acquire_async(self, n: int = 1):
+    wait = self.reserve(n)
+    if wait > 0:
+      await asyncio.sleep(wait)
+    return wait
+
+
+  def thread_calls(self):
+    return self.site.thread_calls()
+
+
+  def mean_rps(self):
+    return self.site.mean_rps()
+
+
+_limiter = None
+_site_limiters = {}
+_site_qps = None
+_site_burst = None
+_limiter_lock = RLock()
+
+
+def configure(qps: float = None, burst: int = None,
+              site_qps: float = None, site_burst: int = None):
+  """set up the process wide limiters
+
+  the project bucket is shared by all sites, every site gets its own
+  bucket on top (1200 queries per minute per site).
+
+  Args:
+    qps: api calls per second for the project (default: {env QPS or 20})
+    burst: project bucket size (default: {env BURST or qps})
+    site_qps: api calls per second per site (default: {env SITE_QPS or 20})
+    site_burst: site bucket size (default: {site_qps})
+
+  Returns:
+    project limiter
+    TokenBucket
+  """
+  global _limiter, _site_qps, _site_burst
+  qps = qps or float(os.environ.get('QPS', 20))
+  burst = burst or (int(os.environ['BURST']) if 'BURST' in os.environ else None)
+  with _limiter_lock:
+    _limiter = TokenBucket(qps, burst)
+    _site_qps = site_qps or float(os.environ.get('SITE_QPS', 20))
+    _site_burst = site_burst
+    _site_limiters.clear()
+  return _limiter
+
+
+def get_limiter(site: str = None):
+  """process wide limiter, configured from env on first use
+
+  Args:
+    site: gsc property, limiter also applies the site bucket (default: {None})
+
+  Returns:
+    project limiter or limiter of site
+    TokenBucket or SiteLimiter
+  """
+  with _limiter_lock:
+    if _limiter is None:
+      configure()
+    if site is None:
+      return _limiter
+    if site not in _site_limiters:
+      _site_limiters[site] = SiteLimiter(TokenBucket(_site_qps, _site_burst),
+                                         _limiter)
+    return _site_limiters[site]
@@ -0,0 +1,103 @@
+#       _                         __    __           __   __      __         __
+#      (_)___  ____  ____  __  __/ /_  / /___ ______/ /__/ /___ _/ /_  ___  / /
+#     / / __ \/ __ \/ __ \/ / / / __ \/ / __ `/ ___/ //_/ / __ `/ __ \/ _ \/ /
+#    / / /_/ / / / / / / / /_/ / /_/ / / /_/ / /__/ ,< / / /_/ / /_/ /  __/ /
+# __/ /\____/_/ /_/_/ /_/\__, /_.___/_/\__,_/\___/_/|_/_/\__,_/_.___/\___/_/
+#/___/                  /____/
+"""
+author: Johannes Kunze
+twitter: @jonnyblacklabel
+web: http://www.jonnyblacklabel.de/
+github: https://github.com/Jonnyblacklabel
+
+columns of the job tables from api_columns.ini
+
+every table has the dimensions of its job as text, date as day,
+clicks and impressions as integer, ctr and position as real and the
+query_queue_id. sinks map these kinds to their own column types.
+"""
+
+from datetime import date
+import config
+import json
+
+
+METRICS = [('clicks', 'integer'),
+           ('impressions', 'integer'),
+           ('ctr', 'real'),
+           ('position', 'real')]
+
+EPOCH = date(1970, 1, 1).toordinal()
+
+
+def table_name(searchtype: str, dimensions, filter_=None):
+  """data table of a job: searchtype_dimensions[_filter]
+
+  Args:
+    searchtype: searchtype of job
+    dimensions: dimensions of job
+    filter_: (dimension, value, operator) of job (default: {None})
+
+  Returns:
+    table name
+    str
+  """
+  tbl_name = searchtype + '_' + '_'.join(dimensions)
+  if filter_ is not None:
+    tbl_name = '_'.join([tbl_name, filter_[1].lower()])
+  return tbl_name
+
+
+def tables(filters=()):
+  """tables of all configured jobs
+
+  tables of filter jobs need the values of their iterator, which only
+  the api knows. they are declared for the given filters.
+
+  Args:
+    filters: (searchtype, filter) of filter jobs, filter as json or tuple (default: {()})
+
+  Returns:
+    table name → dimensions
+    dict
+  """
+  iterators = config.get_filter_iterators()
+  values = {}
+  for searchtype, filter_ in filters:
+    if isinstance(filter_, str):
+      filter_ = json.loads(filter_)
+    if filter_[0] in iterators:
+      values.setdefault(searchtype, set()).add(tuple(filter_))
+  result = {}
+  for searchtype in config.get_searchtypes():
+    for dimensions in config.get_dimension_combinations():
+      result[table_name(searchtype, dimensions)] = tuple(dimensions)
+      for filter_ in sorted(values.get(searchtype, ())):
+        result[table_name(searchtype, dimensions, filter_)] = tuple(dimensions)
+  return result
+
+
+def columns(dimensions, drop_ctr: bool = False):
+  """columns of a table with dimensions
+
+  Args:
+    dimensions: dimensions of job
+    drop_ctr: without ctr, it is clicks / impressions (default: {False})
+
+  Returns:
+    (column, kind) with kind text, day, integer or real
+    list
+  """
+  result = [(dimension, 'text') for dimension in dimensions]
+  result.append(('date', 'day'))
+  result.extend((metric, kind) for metric, kind in METRICS
+                if not (drop_ctr and metric == 'ctr'))
+  result.append(('query_queue_id', 'integer'))
+  return result
+
+
+def epoch_day(value):
+  """days since 1970-01-01 of a date or iso date string"""
+  if isinstance(value, str):
+    value = date.fromisoformat(value[:10])
+  return value.toordinal() - EPOCH
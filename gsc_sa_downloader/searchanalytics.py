@@ -12,93 +12,189 @@ github: https://github.com/Jonnyblacklabel
 """
 
 from searchconsole.query import Query, Report
-from searchconsole.account import Account
-from threading import Thread, get_ident
-from apiclient import discovery
+from concurrent.futures import ThreadPoolExecutor
+from threading import Thread, local
+from datetime import date
 import googleapiclient.errors
 from retrying import retry
 from loguru import logger
+from writer import DbWriter
 from queue import Queue
-from math import ceil
-import numpy as np
-import dataset
+import service_pool
+import ratelimit
+import itertools
+import metrics
+import schema
+import sinks
 import random
 import time
 import json
-import time
-import auth
 import db
 import os
 
 
-def patch_wait(seconds):
-  def _wait(self):
-    now = time.time()
-    elapsed = now - self._lock
-    wait = max(0, seconds - elapsed)
-    time.sleep(wait)
-    self._lock = time.time()
+def error_content(e: googleapiclient.errors.HttpError):
+  return e.content.decode(errors='ignore') \
+         if isinstance(e.content, bytes) else str(e.content)
+
+
+def congestion(e: googleapiclient.errors.HttpError):
+  """congestion flag and Retry-After seconds of an api error"""
+  return (ratelimit.is_congestion(e.resp.status, error_content(e)),
+          ratelimit.parse_retry_after(e.resp.get('retry-after')))
+
+
+def record_error(site, e):
+  """count api error by reason"""
+  if isinstance(e, googleapiclient.errors.HttpError):
+    reason = metrics.error_reason(e.resp.status, error_content(e))
+  else:
+    reason = type(e).__name__
+  metrics.API_ERRORS.inc(site=site, reason=reason)
 
-    return wait
-  Query._wait = _wait
 
 def patch_execute():
   def execute(self):
     raw = self.build()
     url = self.api.url
+    limiter = ratelimit.get_limiter(url)
+    limiter.controller.acquire() # adaptive requests in flight
+    limiter.acquire() # every http call takes a token
+    start = time.monotonic()
     try:
       response = self.api.account.service.searchanalytics().query(
         siteUrl=url, body=raw).execute()
-      self._wait() # put self._wait at the end so first call waits
     except googleapiclient.errors.HttpError as e:
+      congested, retry_after = congestion(e)
+      limiter.controller.release(congested=congested, retry_after=retry_after)
+      metrics.API_CALLS.inc(site=url, method='query', status=e.resp.status)
+      record_error(url, e)
       raise e
+    except Exception as e:
+      limiter.controller.release()
+      record_error(url, e)
+      raise
+    elapsed = time.monotonic() - start
+    limiter.controller.release(elapsed)
+    metrics.API_CALLS.inc(site=url, method='query', status=200)
+    metrics.API_LATENCY.observe(elapsed, site=url, method='query')
     return Report(response, self)
   Query.execute = execute
 
+patch_execute()
+
+ROW_LIMIT = 25000
+MAX_REQUEUES = 3
+PACK_FILL = 0.5 # share of a page a pack is planned for
+PAGE_WINDOW = 4 # pages of one item fetched at once
+
 
 class Client:
 
   def __init__(self, account_name, verbose=False):
-    credentials = self.get_credentials(account_name)
-    service = discovery.build('webmasters','v3',credentials=credentials)
-    self.account = Account(service, credentials)
+    self.account_name = account_name
+    self.pool = service_pool.get_pool(account_name) # shared per account
+    self.account = self.pool.account()
     self.verbose = verbose
     self.months = int(os.environ['MONTHS'])
+    self.date_lists = {}
+    self.iterator_values = {}
 
 
   @staticmethod
   def get_credentials(account_name):
-    return auth.authenticate_gsc(account=account_name,
-                                 client_id=os.environ['CLIENT_ID'],
-                                 client_secret=os.environ['CLIENT_SECRET'])
+    return service_pool.get_pool(account_name).refresh()
 
 
   def get_account(self):
     return self.account
 
   def set_webproperty(self, gsc_property):
-    self.webproperty = self.account[gsc_property]
+    self.webproperty = self.pool.webproperty(self.account, gsc_property)
 
   def get_webproperty(self):
     return self.webproperty
 
 
+  def get_date_list(self, webproperty, searchtype='web', filter_=None):
+    """dates with data, cached per property, searchtype and filter
+
+    Args:
+      webproperty: gsc property
+      searchtype: searchtype (default: {'web'})
+      filter_: json filter of a job [dimension, expression, operator] (default: {None})
+    """
+    key = (self.webproperty.url, searchtype, filter_)
+    if key not in self.date_lists:
+      self.date_lists[key] = self.fetch_date_list(searchtype, filter_)
+    return self.date_lists[key]
+
+
+  def prefetch_date_lists(self, keys, max_workers=4):
+    """fetch dates with data for many (searchtype, filter) concurrently
+
+    every thread uses its own client (http transport) from the account
+    pool, calls are paced by the shared limiter.
+    """
+    url = self.webproperty.url
+    missing = [key for key in set(keys) if (url,) + tuple(key) not in self.date_lists]
+    def fetch(key):
+      client = Client(self.account_name)
+      client.set_webproperty(url)
+      return key, client.fetch_date_list(*key)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+      for key, dates in executor.map(fetch, missing):
+        self.date_lists[(url,) + tuple(key)] = dates
+
+
   @retry(stop_max_attempt_number=5,
          wait_exponential_multiplier=1000,
          wait_exponential_max=10000)
-  def get_date_list(self, webproperty, searchtype='web'):
-    report = self.webproperty \
-                 .query.range('today', months=-(self.months)-1) \
-                 .dimension('date') \
-                 .search_type(searchtype) \
-                 .get()
+  def fetch_date_list(self, searchtype='web', filter_=None):
+    query = self.webproperty \
+                .query.range('today', months=-(self.months)-1) \
+                .dimension('date') \
+                .search_type(searchtype)
+    if filter_ is not None:
+      filter_ = json.loads(filter_)
+      query = query.filter(dimension = filter_[0],
+                           expression = filter_[1],
+                           operator = filter_[2])
+    report = query.get()
     return [row.date for row in report.rows]
 
 
+  def get_iterator_values(self, iterator_dimension, searchtype):
+    """values of dimension, cached per property, dimension and searchtype"""
+    key = (self.webproperty.url, iterator_dimension, searchtype)
+    if key not in self.iterator_values:
+      self.iterator_values[key] = self.fetch_iterator_values(iterator_dimension,
+                                                             searchtype)
+    return self.iterator_values[key]
+
+
+  def prefetch_iterator_values(self, iterator_dimension, searchtypes, max_workers=4):
+    """fetch values of dimension for many searchtypes concurrently
+
+    every thread uses its own client (http transport) from the account
+    pool, calls are paced by the shared limiter.
+    """
+    url = self.webproperty.url
+    missing = [searchtype for searchtype in set(searchtypes)
+               if (url, iterator_dimension, searchtype) not in self.iterator_values]
+    def fetch(searchtype):
+      client = Client(self.account_name)
+      client.set_webproperty(url)
+      return searchtype, client.fetch_iterator_values(iterator_dimension, searchtype)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+      for searchtype, values in executor.map(fetch, missing):
+        self.iterator_values[(url, iterator_dimension, searchtype)] = values
+
+
   @retry(stop_max_attempt_number=5,
          wait_exponential_multiplier=1000,
          wait_exponential_max=10000)
-  def get_iterator_values(self, iterator_dimension, searchtype):
+  def fetch_iterator_values(self, iterator_dimension, searchtype):
     report = self.webproperty \
                  .query.range('today', months=-(self.months)-1) \
                  .dimension(iterator_dimension) \
@@ -114,61 +210,244 @@ class Client:
                               .search_type(job['searchtype'])
     if job['filter'] is not None:
       filter_ = json.loads(job['filter'])
-      query.filter(dimension = filter_[0],
-                    expression = filter_[1],
-                    operator = filter_[2])
+      query = query.filter(dimension = filter_[0], # queries are immutable
+                           expression = filter_[1],
+                           operator = filter_[2])
     return query
 
 
+  def query_pack(self, items, job):
+    """one query for the days of many items of job, date as last dimension"""
+    dates = sorted(str(item['date']) for item in items)
+    return self.query_queue_item(items[0], job) \
+               .range(start=dates[0], stop=dates[-1]) \
+               .dimension(*json.loads(job['dimensions']), 'date')
+
+
 class QueryThreaded:
 
-  def __init__(self, account_name, gsc_property, items, max_workers=10, rps=3):
-    patch_wait(1/rps) # wait n seconds (api rps)
-    patch_execute() # wait on first iteration
+  def __init__(self, account_name, gsc_property, items, max_workers=10,
+               sink='sqlite', stream=False, batch_size=0, pack_days=0,
+               page_window=PAGE_WINDOW, keep_indices=False, drop_ctr=False):
     self.account_name = account_name
     self.gsc_property = gsc_property
     self.tasks = items
     self.max_workers = max_workers
-    self.target_rps = rps
-    self.look_back = 1
-    self.elapsed = []
-    self.hits = []
-    self.db_queue = Queue()
+    self.stream = stream
+    self.batch_size = batch_size
+    self.pack_days = pack_days
+    self.job_rows = {}
+    self.page_window = page_window
+    self.keep_indices = keep_indices # other processes write to the sink
+    self.page_pool = None
+    self.page_local = local()
+    self.limiter = ratelimit.get_limiter(gsc_property)
+    self.sink = sinks.get_sink(sink, account_name, gsc_property, drop_ctr=drop_ctr)
+    # streamed pages are bounded, workers wait for the writer
+    self.db_queue = Queue(maxsize=2*max_workers if stream else 0)
     self.task_queue = Queue()
     self.worker_threads = []
-    self.to_break = []
+    self.writer = None
+    self.logged = set()
 
 
   @staticmethod
   @retry(stop_max_attempt_number=5,
          wait_exponential_multiplier=1000,
          wait_exponential_max=10000)
-  def run_query(query):
-    return query.get()
+  def run_page(query):
+    return query.execute()
+
+
+  def run_page_at(self, query, start_row):
+    """run query from start_row with the client of the page thread
+
+    Returns:
+      report and api calls of the thread
+      tuple
+    """
+    client = getattr(self.page_local, 'client', None)
+    if client is None: # own http transport per page thread
+      client = self.page_local.client = Client(self.account_name)
+      client.set_webproperty(self.gsc_property)
+    calls_before = self.limiter.thread_calls()
+    report = self.run_page(Query(client.webproperty,
+                                 dict(query.raw, startRow=start_row),
+                                 query.meta))
+    return report, self.limiter.thread_calls() - calls_before
+
+
+  def iter_pages(self, query, calls=None):
+    """yield one report per api page, in order
+
+    a page with less rows than rowLimit is the last one. after a full
+    first page the next startRow offsets are fetched at once in rounds
+    of 1, 2, 4, ... pages up to page_window, as long as all pages of a
+    round are full.
+
+    Args:
+      query: query of the first page
+      calls: list, api calls of page threads are appended (default: {None})
+    """
+    row_limit = query.raw.get('rowLimit', ROW_LIMIT)
+    report = self.run_page(query)
+    yield report
+    if len(report) < row_limit:
+      return
+    if self.page_pool is None or self.page_window < 2: # sequential
+      cursor = query.next()
+      while True:
+        report = self.run_page(cursor)
+        yield report
+        if len(report) < row_limit:
+          return
+        cursor = cursor.next()
+    start_row = query.raw.get('startRow', 0) + row_limit
+    window = 1
+    while True:
+      futures = [self.page_pool.submit(self.run_page_at, query, start_row + i * row_limit)
+                 for i in range(window)]
+      try:
+        for future in futures:
+          report, n_calls = future.result()
+          if calls is not None:
+            calls.append(n_calls)
+          yield report
+          if len(report) < row_limit: # later pages are empty
+            return
+      finally:
+        for future in futures: # not started yet
+          future.cancel()
+      start_row += window * row_limit
+      window = min(window * 2, self.page_window)
 
 
-  def fill_task_queue(self):
-    for task in self.tasks:
-      self.task_queue.put(task)
+  @staticmethod
+  def tag_rows(report, item):
+    rows = report.to_dict()
+    for row in rows:
+      row.update(dict(date=item['query']['date'],
+                      query_queue_id=item['query']['id']))
+    return rows
+
+
+  @staticmethod
+  def page_message(item, rows, first=False):
+    """db queue message for a streamed page, item is not finished
+
+    the first page of a fetch replaces rows of earlier attempts.
+    """
+    return dict(tbl_name=item['tbl_name'],
+                report=rows,
+                query_queue_id=item['query']['id'],
+                date=item['query']['date'],
+                queued=time.monotonic(),
+                first=first,
+                final=False)
+
+
+  def streams(self, item):
+    """pages of item go to the writer one by one
+
+    refreshed items are written in one message, so deleting the old
+    rows and inserting the new ones is one transaction.
+    """
+    return self.stream and not item['query'].get('refresh')
+
+
+  @staticmethod
+  def item_message(item, rows, len_rows, elapsed, hits, first=True):
+    """db queue message that finishes item, first if no page was streamed"""
+    return dict(tbl_name=item['tbl_name'],
+                report=rows,
+                query_queue_id=item['query']['id'],
+                date=item['query']['date'],
+                replace=bool(item['query'].get('refresh')),
+                attempts=item['query']['attempts'],
+                report_len=len_rows,
+                elapsed=elapsed,
+                hits=hits,
+                rps=hits / max(elapsed, 1e-6),
+                queued=time.monotonic(),
+                first=first,
+                final=True)
+
+
+  @staticmethod
+  def is_small(item):
+    """item expected to fit in one page: filter job or no page/query dimension"""
+    dimensions = set(json.loads(item['job']['dimensions']))
+    return item['job']['filter'] is not None \
+           or not dimensions & {'page', 'query'}
 
 
-  def add_worker(self, n=1):
-    for i in range(n):
-      thread = Thread(target=self.task_execute)
-      thread.setDaemon(True)
-      thread.start()
-      self.worker_threads.append(thread)
+  def days_per_pack(self, job):
+    """days of job that fit in one request
 
+    the most rows of a fetched day of job decide, jobs without history
+    are packed if they are small.
+
+    Returns:
+      days per request, 1 if job is not packed
+      int
+    """
+    if self.pack_days < 2:
+      return 1
+    max_rows = self.job_rows.get(job['id'])
+    if max_rows is None:
+      return self.pack_days if self.is_small(dict(job=job)) else 1
+    return max(1, min(self.pack_days, int(ROW_LIMIT * PACK_FILL) // max(max_rows, 1)))
+
+
+  def plan_tasks(self):
+    """tasks with consecutive days of low volume jobs packed
+
+    Returns:
+      items and dict(pack=[items]) of one job spanning up to days_per_pack days
+      list
+    """
+    if self.pack_days < 2:
+      return list(self.tasks)
+    by_job = {}
+    for task in self.tasks:
+      by_job.setdefault(task['job']['id'], []).append(task)
+    planned = []
+    for job_tasks in by_job.values():
+      days = self.days_per_pack(job_tasks[0]['job'])
+      pack = []
+      for task in sorted(job_tasks, key=lambda task: str(task['query']['date'])):
+        day = date.fromisoformat(str(task['query']['date']))
+        if pack and (day - date.fromisoformat(str(pack[0]['query']['date']))).days >= days:
+          planned.append(dict(pack=pack) if len(pack) > 1 else pack[0])
+          pack = []
+        pack.append(task)
+      if pack:
+        planned.append(dict(pack=pack) if len(pack) > 1 else pack[0])
+    n_packs = sum('pack' in task for task in planned)
+    logger.info(f'[{len(self.tasks)}] items in [{len(planned)}] tasks - [{n_packs}] packs')
+    return planned
 
-  def remove_worker(self):
-    thread = self.worker_threads[0]
-    self.to_break.append(thread.ident)
+
+  def fill_task_queue(self):
+    batch = []
+    for task in self.plan_tasks():
+      if self.batch_size > 1 and 'pack' not in task and self.is_small(task):
+        batch.append(task)
+        if len(batch) == self.batch_size:
+          self.task_queue.put(dict(batch=batch))
+          batch = []
+      else:
+        self.task_queue.put(task)
+    if batch:
+      self.task_queue.put(dict(batch=batch))
 
 
   def start_task_workers(self):
-    for i in range(self.max_workers):
+    # pacing is done by the shared limiter, more workers than
+    # tasks would only idle
+    for i in range(min(self.max_workers, len(self.tasks))):
       t = Thread(target=self.task_execute)
-      t.setDaemon(True)
+      t.daemon = True
       t.start()
       self.worker_threads.append(t)
 
@@ -178,194 +457,338 @@ class QueryThreaded:
       self.task_queue.put(None)
     for thread in self.worker_threads:
       thread.join()
-
-  def mean_rps(self):
-    # calc mean rps
-    try:
-      return (np.sum(self.hits[-self.look_back:]) / np.sum(self.elapsed[-self.look_back:]))*len(self.worker_threads) # mean rps last n calls
-    except Exception:
-      return 1
+    self.worker_threads = []
 
 
-  def throttle_worker(self):
-    self.add_worker()
-    task_queue_size_start = self.task_queue.qsize()
-    tasks_done_last_60_seconds = 0
-    tasks_done_before_60_seconds = 0
-    start = time.time()
-    while not self.task_queue.empty():
-      # remove dead threads from list
-      for thread in self.worker_threads:
-        if not thread.is_alive():
-            self.worker_threads.remove(thread)
-
-      # queue size
-      task_queue_size = self.task_queue.qsize()
-      tasks_done = task_queue_size_start - task_queue_size
-
-      if time.time() - start >= 60: # after 60 seconds
-        tasks_done_last_60_seconds = tasks_done - tasks_done_before_60_seconds
-        tasks_done_before_60_seconds += tasks_done_last_60_seconds
-
-        self.look_back = tasks_done_last_60_seconds # window for mean rps calc (default 10)
-        # dampen last 60 hits because every worker does pagination.
-        # one does not know for shure if all hits were in 60 seconds window.
-        # hits_last_60_seconds = ceil(np.sum(self.hits[-self.look_back:]) / 2**(np.log10(len(self.worker_threads))/10))
-        hits_last_60_seconds = np.sum(self.hits[-self.look_back:])
-
-        # adding workers
-        if 0 < (hits_last_60_seconds + (hits_last_60_seconds / len(self.worker_threads))) <= 60 * self.target_rps:
-          if len(self.worker_threads) < self.max_workers \
-          and len(self.worker_threads) < self.task_queue.qsize(): # max not reached
-            logger.info(f'hits in 60 seconds [{hits_last_60_seconds}] - adding 1 worker')
-            self.add_worker()
-            # time.sleep(2**len(self.worker_threads)*1) # wait based on len workers
-
-        # removing workers
-        if hits_last_60_seconds > 60 * self.target_rps \
-        and len(self.worker_threads) > 1: # rps to high, remove worker
-          logger.info(f'hits in 60 seconds [{hits_last_60_seconds}] - removing 1 worker')
-          self.remove_worker()
-
-        time.sleep(.5)
-        start = time.time() # reset start time
-
-    # ending workers
-    self.task_queue.join() # wait till queue is done
-    self.stop_task_workers()
+  def process_tasks(self):
+    # further pages of big items, shared by all workers
+    self.page_pool = ThreadPoolExecutor(max_workers=self.max_workers)
+    try:
+      self.start_task_workers()
+      self.task_queue.join() # wait till queue is done
+      self.stop_task_workers()
+    finally:
+      self.page_pool.shutdown()
+      self.page_pool = None
 
 
   def task_execute(self):
     client = Client(self.account_name)
     client.set_webproperty(self.gsc_property)
-    n_errors = 0
     while True:
-      if get_ident() in self.to_break: # break worker if in to break
-        break
       item = self.task_queue.get()
       if item is None: # break worker if None item in queue
+        self.task_queue.task_done()
         break
+      metrics.ACTIVE_WORKERS.inc(site=self.gsc_property)
       try:
-        start = time.time()
-        query = client.query_queue_item(item['query'], item['job']) # build query
-        query._lock = start # set lock for searchconsole client
-        report = self.run_query(query) # run query
-        dict_rows = report.to_dict()
-        len_rows = len(report)
-        hits = max(2, ceil((len_rows / 25000)+1))
-        elapsed = time.time() - start
-        rps = hits / elapsed
-        self.elapsed.append(elapsed) # add to object elapsed
-        self.hits.append(hits) # add to object hits
-        for row in dict_rows:
-          row.update(dict(date=item['query']['date'],
-                          query_queue_id=item['query']['id']))
+        if 'batch' in item:
+          self.fetch_batch(client, item['batch'])
+          continue
+        if 'pack' in item:
+          self.fetch_pack(client, item['pack'])
+          continue
+        message = self.fetch_item(client, item)
       except googleapiclient.errors.HttpError as e:
-        n_errors += 1
-        logger.error(e)
-        if n_errors < 2:
-          logger.warning(f'error [{n_errors}] - waiting for 20 Minutes to continue.')
-          time.sleep(60*20)
-        else:
-          logger.warning(f'error [{n_errors}] - exit - try again later / tomorrow.')
-          break
+        # retries are exhausted, controller already backed off
+        for item_ in item.get('batch', item.get('pack', [item])):
+          self.requeue(item_, e)
       except Exception as e:
         logger.exception(e)
-        break
+        metrics.ITEMS.inc(site=self.gsc_property, result='failed')
       else:
-        mean_rps = self.mean_rps()
-        logger.info(f'[{len(self.worker_threads)}] worker - [{round(rps,3)}] rps - [{round(mean_rps,3)}] mean rps - [{len(report)}] rows - [{hits}] hits - {item["query"]["date"]} - {item["job"]["dimensions"]} - {item["job"]["searchtype"]} - {item["job"]["filter"]}')
-        self.db_queue.put(dict(tbl_name=item['tbl_name'],
-                               report=dict_rows,
-                               query_queue_id=item['query']['id'],
-                               attempts=item['query']['attempts'],
-                               report_len=len_rows,
-                               elapsed=elapsed,
-                               hits=hits,
-                               rps=rps))
+        self.log_message(item, message)
+        self.db_queue.put(message)
       finally:
+        metrics.ACTIVE_WORKERS.dec(site=self.gsc_property)
         self.task_queue.task_done()
 
 
+  def requeue(self, item, error):
+    """put failed item back to the end of the task queue, MAX_REQUEUES times"""
+    item['requeued'] = item.get('requeued', 0) + 1
+    if item['requeued'] > MAX_REQUEUES:
+      metrics.ITEMS.inc(site=self.gsc_property, result='failed')
+      logger.error(f'{error} - giving up - {item["query"]["date"]} - {item["job"]["dimensions"]} - {item["job"]["searchtype"]} - {item["job"]["filter"]}')
+      return
+    metrics.ITEMS.inc(site=self.gsc_property, result='requeued')
+    logger.warning(f'{error} - requeue [{item["requeued"]}] - {item["query"]["date"]} - {item["job"]["dimensions"]} - {item["job"]["searchtype"]} - {item["job"]["filter"]}')
+    self.task_queue.put(item)
+
 
-  def db_writer(self):
-    t_db = dataset.connect('sqlite:///' \
-                           +os.path.join(os.environ['SQLITE_PATH'],\
-                                         self.account_name+'.db'),
-                           engine_kwargs=dict(connect_args={'check_same_thread':False}))
-    time.sleep(10)
-    while self.worker_threads or not self.db_queue.empty():
-      if not self.db_queue.empty():
-        item = self.db_queue.get()
-        if item is None:
-          del t_db
-          break
-        table = t_db[item['tbl_name']]
-
-        table.insert_many(item['report'])
-        db.update_query_queue_item(item['query_queue_id'],
-                                   attempts=item['attempts']+1,
-                                   finished=True,
-                                   rows=item['report_len'],
-                                   seconds=item['elapsed'],
-                                   hits=item['hits'],
-                                   rps=item['rps'])
-        self.db_queue.task_done()
-      elif self.worker_threads:
-        time.sleep(5)
+  def lost_items(self):
+    """items the writer lost rows of, fetched again MAX_REQUEUES times"""
+    items = []
+    for task in self.tasks:
+      if task['query']['id'] not in self.writer.failed:
+        continue
+      task['requeued'] = task.get('requeued', 0) + 1
+      if task['requeued'] > MAX_REQUEUES:
+        metrics.ITEMS.inc(site=self.gsc_property, result='failed')
+        logger.error(f'rows not written - giving up - {task["query"]["date"]} - {task["job"]["dimensions"]} - {task["job"]["searchtype"]} - {task["job"]["filter"]}')
       else:
-        del t_db
-
-  def drop_indices(self):
-    table = self.tasks[0]['tbl_name']
-    logger.info(f'dropping indices for {table}')
-    t_db = dataset.connect('sqlite:///' \
-                           +os.path.join(os.environ['SQLITE_PATH'],\
-                                         self.account_name+'.db'),
-                           engine_kwargs=dict(connect_args={'check_same_thread':False}))
-    drop_index_qqid = f'DROP INDEX IF EXISTS {table}_query_queue_id_idx;'
-    drop_index_date = f'DROP INDEX IF EXISTS {table}_date_idx;'
-    t_db.query(drop_index_qqid)
-    t_db.query(drop_index_date)
-    del t_db
-
-
-  def create_indices(self):
-    table = self.tasks[0]['tbl_name']
-    logger.info(f'creating indices for {table}')
-    t_db = dataset.connect('sqlite:///' \
-                           +os.path.join(os.environ['SQLITE_PATH'],\
-                                         self.account_name+'.db'),
-                           engine_kwargs=dict(connect_args={'check_same_thread':False}))
-    create_index_qqid = f'CREATE INDEX IF NOT EXISTS {table}_query_queue_id_idx ON {table} (query_queue_id);'
-    create_index_date = f'CREATE INDEX IF NOT EXISTS {table}_date_idx ON {table} (date);'
-    t_db.query(create_index_qqid)
-    t_db.query(create_index_date)
-    del t_db
+        metrics.ITEMS.inc(site=self.gsc_property, result='requeued')
+        items.append(task)
+    if items:
+      logger.warning(f'fetching [{len(items)}] items again, the writer lost their rows')
+    return items
+
+
+  def log_message(self, item, message):
+    logger.info(f'[{len(self.worker_threads)}] worker - [{int(self.limiter.controller.limit)}] limit - [{round(message["rps"],3)}] rps - [{round(self.limiter.mean_rps(),3)}] mean rps - [{message["report_len"]}] rows - [{message["hits"]}] hits - {item["query"]["date"]} - {item["job"]["dimensions"]} - {item["job"]["searchtype"]} - {item["job"]["filter"]}')
 
 
+  def fetch_item(self, client, item, first_page=None):
+    """fetch all pages of item
+
+    Args:
+      client: client of worker
+      item: queue item
+      first_page: raw response of first page from a batch (default: {None})
+
+    Returns:
+      db queue message that finishes item
+      dict
+    """
+    start = time.time()
+    calls_before = self.limiter.thread_calls()
+    query = client.query_queue_item(item['query'], item['job']) # build query
+    page_calls = []
+    if first_page is None:
+      pages = self.iter_pages(query, page_calls)
+    else:
+      first_page = Report(first_page, query)
+      pages = [first_page]
+      if len(first_page) >= ROW_LIMIT: # more pages, continue paging
+        pages = itertools.chain(pages, self.iter_pages(query.next(), page_calls))
+    dict_rows = []
+    len_rows = 0
+    n_pages = 0
+    for report in pages: # run query
+      rows = self.tag_rows(report, item)
+      len_rows += len(rows)
+      n_pages += 1
+      if self.streams(item): # hand over page right away
+        self.db_queue.put(self.page_message(item, rows, first=n_pages == 1))
+      else:
+        dict_rows.extend(rows)
+    hits = self.limiter.thread_calls() - calls_before # real http calls
+    hits += sum(page_calls) + (first_page is not None)
+    elapsed = time.time() - start
+    self.record_item(len_rows, n_pages)
+    return self.item_message(item, dict_rows, len_rows, elapsed, hits,
+                             first=not self.streams(item))
+
+
+  def record_item(self, len_rows, n_pages, n_items=1):
+    metrics.ITEMS.inc(n_items, site=self.gsc_property, result='fetched')
+    metrics.ROWS.inc(len_rows, site=self.gsc_property)
+    metrics.PAGES.observe(n_pages, site=self.gsc_property)
+
+
+  def split_pack(self, items, reports, elapsed, hits):
+    """split rows of a pack by date into one finishing message per item
+
+    rows of days without item (finished before) are dropped. the api
+    calls are booked on the first item.
+
+    Returns:
+      db queue messages
+      list
+    """
+    by_date = {str(item['query']['date']): [] for item in items}
+    n_pages = 0
+    for report in reports:
+      n_pages += 1
+      for row in report.to_dict():
+        day = row.pop('date')
+        if day in by_date:
+          by_date[day].append(row)
+    messages = []
+    for i, item in enumerate(items):
+      rows = by_date[str(item['query']['date'])]
+      for row in rows: # same columns as a daily fetch
+        row.update(dict(date=item['query']['date'],
+                        query_queue_id=item['query']['id']))
+      messages.append(self.item_message(item, rows, len(rows), elapsed,
+                                        hits if i == 0 else 0))
+    self.record_item(sum(len(m['report']) for m in messages), n_pages, len(items))
+    return messages
+
+
+  def fetch_pack(self, client, items):
+    """fetch the days of many items of one job with date as dimension"""
+    start = time.time()
+    calls_before = self.limiter.thread_calls()
+    query = client.query_pack([item['query'] for item in items], items[0]['job'])
+    page_calls = []
+    reports = list(self.iter_pages(query, page_calls))
+    hits = self.limiter.thread_calls() - calls_before + sum(page_calls)
+    messages = self.split_pack(items, reports, time.time() - start, hits)
+    for item, message in zip(items, messages):
+      self.log_message(item, message)
+      self.db_queue.put(message)
+
+
+  def fetch_batch(self, client, items):
+    """fetch first pages of many items in one http batch request
+
+    responses are matched to items by query_queue_id. failed items go
+    back to the task queue, full first pages continue with normal paging.
+    an item failing on a later page is requeued alone.
+    """
+    service = client.account.service
+    responses = {}
+    def callback(request_id, response, exception):
+      responses[int(request_id)] = (response, exception)
+    batch = service.new_batch_http_request(callback=callback)
+    for item in items:
+      body = client.query_queue_item(item['query'], item['job']).build()
+      batch.add(service.searchanalytics().query(siteUrl=self.gsc_property,
+                                                body=body),
+                request_id=str(item['query']['id']))
+    controller = self.limiter.controller
+    controller.acquire() # one request in flight
+    self.limiter.acquire(len(items)) # every sub request counts
+    start = time.monotonic()
+    try:
+      batch.execute()
+    except googleapiclient.errors.HttpError as e:
+      congested, retry_after = congestion(e)
+      controller.release(congested=congested, retry_after=retry_after)
+      metrics.API_CALLS.inc(site=self.gsc_property, method='batch', status=e.resp.status)
+      record_error(self.gsc_property, e)
+      raise e
+    except Exception as e:
+      controller.release()
+      record_error(self.gsc_property, e)
+      raise
+    metrics.API_CALLS.inc(site=self.gsc_property, method='batch', status=200)
+    metrics.API_LATENCY.observe(time.monotonic() - start,
+                                site=self.gsc_property, method='batch')
+    for response, exception in responses.values():
+      if exception is not None:
+        record_error(self.gsc_property, exception)
+    errors = [congestion(exception) for response, exception in responses.values()
+              if isinstance(exception, googleapiclient.errors.HttpError)]
+    if any(congested for congested, retry_after in errors):
+      controller.release(congested=True,
+                         retry_after=max((retry_after for congested, retry_after in errors
+                                          if retry_after is not None), default=None))
+    else:
+      controller.release(time.monotonic() - start)
+    for item in items:
+      response, exception = responses.get(item['query']['id'], (None, None))
+      if exception is not None or response is None:
+        self.requeue(item, exception)
+        continue
+      try:
+        message = self.fetch_item(client, item, first_page=response)
+      except googleapiclient.errors.HttpError as e: # siblings are written
+        self.requeue(item, e)
+        continue
+      except Exception as e:
+        logger.exception(e)
+        metrics.ITEMS.inc(site=self.gsc_property, result='failed')
+        continue
+      self.log_message(item, message)
+      self.db_queue.put(message)
+
+
+  def track_queues(self):
+    site = self.gsc_property
+    controller = self.limiter.controller
+    metrics.TASK_QUEUE.track(lambda: self.task_queue.qsize(), site=site)
+    metrics.DB_QUEUE.track(self.db_queue.qsize, site=site)
+    metrics.IN_FLIGHT.track(lambda: controller.in_flight, site=site)
+    metrics.IN_FLIGHT_LIMIT.track(lambda: controller.limit, site=site)
+
+
+  def untrack_queues(self):
+    for gauge in [metrics.TASK_QUEUE, metrics.DB_QUEUE,
+                  metrics.IN_FLIGHT, metrics.IN_FLIGHT_LIMIT]:
+      gauge.remove(site=self.gsc_property)
+
+
+  def tables(self):
+    return sorted({task['tbl_name'] for task in self.tasks})
+
+
+  def declare(self):
+    """typed tables of the run from api_columns.ini
+
+    tables of jobs outside the config get the columns of their rows.
+    """
+    declared = schema.tables({(task['job']['searchtype'], task['job']['filter'])
+                              for task in self.tasks if task['job']['filter'] is not None})
+    tables = self.tables()
+    unknown = [table for table in tables if table not in declared]
+    if unknown:
+      logger.warning(f'{len(unknown)} tables not in api_columns.ini - {unknown[:5]}')
+    self.sink.declare({table: declared[table] for table in tables if table in declared})
+
+
+  def reconcile(self):
+    """finish items the sink has written but the root db missed
+
+    a crash between the sink commit and the root db update leaves
+    finished rows for unfinished items. they are marked finished
+    instead of being downloaded again. other logged items get their
+    rows replaced by the writer.
+    """
+    logged = self.sink.logged()
+    self.logged = set(logged)
+    done = [task for task in self.tasks
+            if logged.get(task['query']['id'], {}).get('finished')
+            and not task['query'].get('refresh')]
+    if done:
+      db.update_query_queue_items_status([(task['query']['id'],
+                                           task['query']['attempts']+1,
+                                           True,
+                                           logged[task['query']['id']]['rows'],
+                                           None, None, None)
+                                          for task in done])
+      logger.info(f'{len(done)} items were written before, marked finished')
+      done = {task['query']['id'] for task in done}
+      self.tasks = [task for task in self.tasks if task['query']['id'] not in done]
 
 
   def run(self):
     if len(self.tasks) > 0:
+      db.init_query_queue() # status columns for bulk updates
+      self.reconcile()
+      if self.pack_days > 1:
+        self.job_rows = db.get_job_max_rows(self.tasks[0]['query']['gsc_property_id'])
       needs_new_indices = False
-      if len(self.tasks) > 50:
-        self.drop_indices()
+      # refreshed items delete by query_queue_id, keep the index
+      refresh = any(task['query'].get('refresh') for task in self.tasks)
+      if len(self.tasks) > 50 and not refresh and not self.keep_indices:
+        self.sink.drop_indices(self.tables())
         needs_new_indices = True
 
-      self.fill_task_queue()
+      self.declare()
+      self.track_queues()
+
+      tasks = self.tasks
+      known = self.logged
+      while self.tasks: # again for items the writer lost rows of
+        self.fill_task_queue()
+        self.writer = DbWriter(self.sink, self.db_queue, known=known)
+        db_thread = Thread(target=self.writer.run)
+        db_thread.daemon = True
+        db_thread.start()
 
-      db_thread = Thread(target=self.db_writer)
-      db_thread.setDaemon(True)
-      db_thread.start()
+        self.process_tasks()
 
-      self.throttle_worker()
+        self.db_queue.put(None) # writer drains queue and commits
+        db_thread.join()
+        known = self.writer.known
+        self.tasks = self.lost_items()
+      self.tasks = tasks
 
-      self.db_queue.join()
-      self.db_queue.put(None)
-      db_thread.join()
+      self.untrack_queues()
 
       if needs_new_indices:
-        self.create_indices()
+        self.sink.create_indices(self.tables())
     else:
       logger.info('nothing to fetch.')
\ No newline at end of file
@@ -0,0 +1,242 @@
+#       _                         __    __           __   __      __         __
+#      (_)___  ____  ____  __  __/ /_  / /___ ______/ /__/ /___ _/ /_  ___  / /
+#     / / __ \/ __ \/ __ \/ / / / __ \/ / __ `/ ___/ //_/ / __ `/ __ \/ _ \/ /
+#    / / /_/ / / / / / / / /_/ / /_/ / / /_/ / /__/ ,< / / /_/ / /_/ /  __/ /
+# __/ /\____/_/ /_/_/ /_/\__, /_.___/_/\__,_/\___/_/|_/_/\__,_/_.___/\___/_/
+#/___/                  /____/
+"""
+author: Johannes Kunze
+twitter: @jonnyblacklabel
+web: http://www.jonnyblacklabel.de/
+github: https://github.com/Jonnyblacklabel
+"""
+
+from searchanalytics import Client, QueryThreaded, ROW_LIMIT, MAX_REQUEUES, PAGE_WINDOW
+from searchconsole.query import Report
+from urllib.parse import quote
+from loguru import logger
+import ratelimit
+import metrics
+import asyncio
+import aiohttp
+import time
+
+
+class ApiError(Exception):
+
+  def __init__(self, status, reason, retry_after=None):
+    super().__init__(f'{status} - {reason}')
+    self.status = status
+    self.reason = reason
+    self.retry_after = retry_after
+
+
+class ClientError(ApiError):
+  """4xx answer that is no congestion, a retry gets the same answer"""
+
+
+class QueryAsync(QueryThreaded):
+  """asyncio engine for query queue items
+
+  same inputs as QueryThreaded. instead of one thread per worker,
+  max_workers coroutines share one http session and one event loop,
+  so hundreds of requests can be in flight under the shared limiter.
+  rows are handed to the same db writer thread.
+  """
+
+  def __init__(self, account_name, gsc_property, items, max_workers=200,
+               sink='sqlite', stream=False, batch_size=0, pack_days=0,
+               page_window=PAGE_WINDOW, keep_indices=False, drop_ctr=False):
+    super().__init__(account_name, gsc_property, items, max_workers=max_workers,
+                     sink=sink, stream=stream, pack_days=pack_days,
+                     page_window=page_window, keep_indices=keep_indices,
+                     drop_ctr=drop_ctr)
+    if batch_size:
+      logger.warning('batch requests are not used by the async engine')
+    self.retries = 5
+
+
+  def fill_task_queue(self):
+    pass # fetch_all plans the tasks into its asyncio queue
+
+
+  def process_tasks(self):
+    asyncio.run(self.fetch_all())
+
+
+  async def fetch_all(self):
+    self.client = Client(self.account_name)
+    self.client.set_webproperty(self.gsc_property)
+    self.pool = self.client.pool
+    self.token_lock = asyncio.Lock()
+    self.url = self.pool.api_url() + 'sites/' \
+               + quote(self.gsc_property, safe='') + '/searchAnalytics/query'
+    queue = self.task_queue = asyncio.Queue() # tracked queue depth
+    tasks = self.plan_tasks()
+    for task in tasks:
+      queue.put_nowait(task)
+    connector = aiohttp.TCPConnector(limit=self.max_workers)
+    timeout = aiohttp.ClientTimeout(total=300)
+    async with aiohttp.ClientSession(connector=connector,
+                                     timeout=timeout) as session:
+      workers = [asyncio.create_task(self.task_execute_async(session, queue))
+                 for i in range(min(self.max_workers, len(tasks)))]
+      await queue.join()
+      for worker in workers:
+        worker.cancel()
+      await asyncio.gather(*workers, return_exceptions=True)
+
+
+  async def get_token(self):
+    async with self.token_lock:
+      if not self.pool.credentials.valid:
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self.pool.refresh)
+    return self.pool.credentials.token
+
+
+  async def post(self, session, body):
+    controller = self.limiter.controller
+    for attempt in range(self.retries):
+      await controller.acquire_async() # adaptive requests in flight
+      congested = False
+      release = {} # outcome for the controller, none if cancelled or failed
+      try:
+        await self.limiter.acquire_async()
+        token = await self.get_token()
+        headers = {'Authorization': f'Bearer {token}'}
+        start = time.monotonic()
+        async with session.post(self.url, json=body, headers=headers) as response:
+          metrics.API_CALLS.inc(site=self.gsc_property, method='query',
+                                status=response.status)
+          if response.status < 400:
+            data = await response.json()
+            elapsed = time.monotonic() - start
+            release = dict(latency=elapsed)
+            metrics.API_LATENCY.observe(elapsed, site=self.gsc_property, method='query')
+            return data
+          error = ApiError(response.status, await response.text(),
+                           ratelimit.parse_retry_after(response.headers.get('Retry-After')))
+        congested = ratelimit.is_congestion(error.status, error.reason)
+        release = dict(congested=congested, retry_after=error.retry_after)
+        metrics.API_ERRORS.inc(site=self.gsc_property,
+                               reason=metrics.error_reason(error.status, error.reason))
+      except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        error = e
+        metrics.API_ERRORS.inc(site=self.gsc_property, reason=type(e).__name__)
+      finally: # also a speculative page cancelled while waiting for a token
+        controller.release(**release)
+      if isinstance(error, ApiError) and error.status < 500 and not congested:
+        raise ClientError(error.status, error.reason)
+      if attempt + 1 < self.retries:
+        logger.warning(f'{error} - retry [{attempt+1}]')
+        if not congested: # controller pauses on congestion
+          await asyncio.sleep(min(2**attempt, 10))
+    raise error
+
+
+  async def iter_pages_async(self, session, query):
+    """yield one report per api page, in order
+
+    after a full first page the next startRow offsets are posted at once
+    in rounds of 1, 2, 4, ... pages up to page_window.
+    """
+    body = query.build()
+    body['rowLimit'] = ROW_LIMIT
+    body['startRow'] = 0
+    response = await self.post(session, body)
+    yield Report(response, query)
+    if len(response.get('rows', [])) < ROW_LIMIT:
+      return
+    start_row = ROW_LIMIT
+    window = 1
+    while True:
+      tasks = [asyncio.ensure_future(self.post(session, dict(body, startRow=start_row + i * ROW_LIMIT)))
+               for i in range(window)]
+      try:
+        for task in tasks:
+          response = await task
+          yield Report(response, query)
+          if len(response.get('rows', [])) < ROW_LIMIT: # later pages are empty
+            return
+      finally:
+        for task in tasks:
+          task.cancel()
+      start_row += window * ROW_LIMIT
+      window = min(window * 2, max(self.page_window, 1))
+
+
+  async def fetch_pack_async(self, session, items):
+    """fetch the days of many items of one job with date as dimension"""
+    loop = asyncio.get_running_loop()
+    start = time.time()
+    query = self.client.query_pack([item['query'] for item in items], items[0]['job'])
+    reports = [report async for report in self.iter_pages_async(session, query)]
+    messages = self.split_pack(items, reports, time.time() - start, len(reports))
+    for item, message in zip(items, messages):
+      logger.info(f'[async] - [pack] - [{message["report_len"]}] rows - [{message["hits"]}] hits - {item["query"]["date"]} - {item["job"]["dimensions"]} - {item["job"]["searchtype"]} - {item["job"]["filter"]}')
+      await loop.run_in_executor(None, self.db_queue.put, message)
+
+
+  def give_up_async(self, item, error):
+    metrics.ITEMS.inc(site=self.gsc_property, result='failed')
+    logger.error(f'{error} - giving up - {item["query"]["date"]} - {item["job"]["dimensions"]} - {item["job"]["searchtype"]} - {item["job"]["filter"]}')
+
+
+  def requeue_async(self, queue, item, error):
+    item['requeued'] = item.get('requeued', 0) + 1
+    if item['requeued'] > MAX_REQUEUES:
+      self.give_up_async(item, error)
+    else:
+      metrics.ITEMS.inc(site=self.gsc_property, result='requeued')
+      logger.warning(f'{error} - requeue [{item["requeued"]}] - {item["query"]["date"]} - {item["job"]["dimensions"]} - {item["job"]["searchtype"]} - {item["job"]["filter"]}')
+      queue.put_nowait(item)
+
+
+  async def task_execute_async(self, session, queue):
+    loop = asyncio.get_running_loop()
+    while True:
+      item = await queue.get()
+      metrics.ACTIVE_WORKERS.inc(site=self.gsc_property)
+      if 'pack' in item:
+        try:
+          await self.fetch_pack_async(session, item['pack'])
+        except ClientError as e:
+          for item_ in item['pack']:
+            self.give_up_async(item_, e)
+        except Exception as e: # single days on retry
+          for item_ in item['pack']:
+            self.requeue_async(queue, item_, e)
+        finally:
+          metrics.ACTIVE_WORKERS.dec(site=self.gsc_property)
+          queue.task_done()
+        continue
+      try:
+        start = time.time()
+        query = self.client.query_queue_item(item['query'], item['job'])
+        dict_rows = []
+        len_rows = 0
+        hits = 0
+        async for report in self.iter_pages_async(session, query):
+          hits += 1
+          rows = self.tag_rows(report, item)
+          len_rows += len(rows)
+          if self.streams(item): # bounded queue, wait for writer off the loop
+            await loop.run_in_executor(None, self.db_queue.put,
+                                       self.page_message(item, rows, first=hits == 1))
+          else:
+            dict_rows.extend(rows)
+        elapsed = time.time() - start
+        self.record_item(len_rows, hits)
+      except ClientError as e:
+        self.give_up_async(item, e)
+      except Exception as e:
+        self.requeue_async(queue, item, e)
+      else:
+        message = self.item_message(item, dict_rows, len_rows, elapsed, hits,
+                                    first=not self.streams(item))
+        logger.info(f'[async] - [{int(self.limiter.controller.limit)}] limit - [{round(message["rps"],3)}] rps - [{round(self.limiter.mean_rps(),3)}] mean rps - [{len_rows}] rows - [{hits}] hits - {item["query"]["date"]} - {item["job"]["dimensions"]} - {item["job"]["searchtype"]} - {item["job"]["filter"]}')
+        await loop.run_in_executor(None, self.db_queue.put, message)
+      finally:
+        metrics.ACTIVE_WORKERS.dec(site=self.gsc_property)
+        queue.task_done()
@@ -0,0 +1,133 @@
+#       _                         __    __           __   __      __         __
+#      (_)___  ____  ____  __  __/ /_  / /___ ______/ /__/ /___ _/ /_  ___  / /
+#     / / __ \/ __ \/ __ \/ / / / __ \/ / __ `/ ___/ //_/ / __ `/ __ \/ _ \/ /
+#    / / /_/ / / / / / / / /_/ / /_/ / / /_/ / /__/ ,< / / /_/ / /_/ /  __/ /
+# __/ /\____/_/ /_/_/ /_/\__, /_.___/_/\__,_/\___/_/|_/_/\__,_/_.___/\___/_/
+#/___/                  /____/
+"""
+author: Johannes Kunze
+twitter: @jonnyblacklabel
+web: http://www.jonnyblacklabel.de/
+github: https://github.com/Jonnyblacklabel
+"""
+
+from searchconsole.account import Account, WebProperty
+from googleapiclient import discovery, discovery_cache
+from threading import Lock
+from loguru import logger
+import google_auth_httplib2
+import hashlib
+import httplib2
+import json
+import auth
+import os
+
+
+DISCOVERY_URL = 'https://www.googleapis.com/discovery/v1/apis/webmasters/v3/rest'
+
+
+class ServicePool:
+  """shared credentials, discovery document and sites of one account
+
+  credentials are loaded once and refreshed centrally. every call of
+  service() builds a ready webmasters service from the cached discovery
+  document with its own http transport, because httplib2 is not thread
+  safe.
+
+  Args:
+    account_name: name of account (credentials filename)
+    credentials: use these credentials instead of the cache (default: {None})
+  """
+
+  def __init__(self, account_name: str, credentials=None):
+    self.account_name = account_name
+    self.credentials = credentials or auth.authenticate_gsc(
+      account=account_name,
+      client_id=os.environ['CLIENT_ID'],
+      client_secret=os.environ['CLIENT_SECRET'])
+    self.discovery_url = os.environ.get('GSC_DISCOVERY_URL', DISCOVERY_URL)
+    self._lock = Lock()
+    self._document = None
+    self._sites = None
+
+
+  def document(self):
+    """discovery document, fetched once and cached in SQLITE_PATH
+
+    the document shipped with google-api-python-client is used for the
+    default discovery url, so no request is needed at all.
+    """
+    with self._lock:
+      if self._document is None and self.discovery_url == DISCOVERY_URL:
+        self._document = discovery_cache.get_static_doc('webmasters', 'v3')
+      if self._document is None:
+        key = hashlib.md5(self.discovery_url.encode()).hexdigest()[:8]
+        path = os.path.join(os.environ['SQLITE_PATH'], f'discovery_{key}.json')
+        try:
+          with open(path) as f:
+            self._document = f.read()
+        except FileNotFoundError:
+          logger.info(f'fetching discovery document {self.discovery_url}')
+          response, content = httplib2.Http().request(self.discovery_url)
+          if response.status >= 400:
+            raise RuntimeError(f'discovery document [{response.status}]')
+          self._document = content.decode()
+          with open(path, 'w') as f:
+            f.write(self._document)
+    return self._document
+
+
+  def api_url(self):
+    """base url of webmasters api"""
+    document = json.loads(self.document())
+    return document['rootUrl'] + document['servicePath']
+
+
+  def refresh(self):
+    """refresh token if expired"""
+    with self._lock:
+      if not self.credentials.valid:
+        request = google_auth_httplib2.Request(httplib2.Http())
+        self.credentials.refresh(request)
+    return self.credentials
+
+
+  def service(self):
+    """webmasters service with its own http transport"""
+    self.refresh()
+    http = google_auth_httplib2.AuthorizedHttp(self.credentials,
+                                               http=httplib2.Http(timeout=300))
+    return discovery.build_from_document(self.document(), http=http)
+
+
+  def account(self):
+    return Account(self.service(), self.credentials)
+
+
+  def webproperty(self, account: Account, gsc_property: str):
+    """web property of account, sites list is fetched once"""
+    with self._lock:
+      if self._sites is None:
+        self._sites = account.service.sites().list().execute().get('siteEntry', [])
+    for raw in self._sites:
+      if raw['siteUrl'] == gsc_property:
+        return WebProperty(raw, account)
+    return None
+
+
+_pools = {}
+_pools_lock = Lock()
+
+
+def get_pool(account_name: str):
+  """service pool of account, created on first use"""
+  with _pools_lock:
+    if account_name not in _pools:
+      _pools[account_name] = ServicePool(account_name)
+    return _pools[account_name]
+
+
+def set_pool(account_name: str, pool: ServicePool):
+  """register pool for account (e.g. with own credentials)"""
+  with _pools_lock:
+    _pools[account_name] = pool
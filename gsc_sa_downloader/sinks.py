@@ -0,0 +1,834 @@
+#       _                         __    __           __   __      __         __
+#      (_)___  ____  ____  __  __/ /_  / /___ ______/ /__/ /___ _/ /_  ___  / /
+#     / / __ \/ __ \/ __ \/ / / / __ \/ / __ `/ ___/ //_/ / __ `/ __ \/ _ \/ /
+#    / / /_/ / / / / / / / /_/ / /_/ / / /_/ / /__/ ,< / / /_/ / /_/ /  __/ /
+# __/ /\____/_/ /_/_/ /_/\__, /_.___/_/\__,_/\___/_/|_/_/\__,_/_.___/\___/_/
+#/___/                  /____/
+"""
+author: Johannes Kunze
+twitter: @jonnyblacklabel
+web: http://www.jonnyblacklabel.de/
+github: https://github.com/Jonnyblacklabel
+"""
+
+from collections import OrderedDict
+from typing import List
+from datetime import date
+from loguru import logger
+import sqlite3
+import shutil
+import schema
+import json
+import re
+import os
+
+
+PRAGMAS = ['PRAGMA journal_mode=WAL',
+           'PRAGMA synchronous=NORMAL',
+           'PRAGMA temp_store=MEMORY',
+           'PRAGMA cache_size=-65536']
+
+LOG_TABLE = '_item_log'
+
+SQLITE_TYPES = {'text': 'TEXT',
+                'day': 'INTEGER',
+                'integer': 'INTEGER',
+                'real': 'REAL'}
+
+sqlite3.register_adapter(date, date.isoformat)
+
+
+def property_slug(gsc_property: str):
+  """file name of a property
+
+  https://www.example.com/ → https_www.example.com,
+  sc-domain:example.com → sc-domain_example.com
+  """
+  return re.sub(r'[^A-Za-z0-9.-]+', '_', gsc_property).strip('_')
+
+
+def column_type(value):
+  """sqlite column type for python value"""
+  if isinstance(value, bool) or isinstance(value, int):
+    return 'INTEGER'
+  if isinstance(value, float):
+    return 'FLOAT'
+  if isinstance(value, date):
+    return 'DATE'
+  return 'TEXT'
+
+
+def has_lookup_tables(con):
+  """True if the sqlite file has dim_* tables of the normalized sink"""
+  return con.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' "
+                     "AND name LIKE 'dim\\_%' ESCAPE '\\'").fetchone() is not None
+
+
+class SqliteSink:
+  """rows into one sqlite table per job in {SQLITE_PATH}/{account_name}/{property_slug}.db
+
+  every written item is recorded in _item_log in the same transaction
+  as its rows. declared tables are created typed on open (date as days
+  since 1970-01-01), every table gets one insert statement over all of
+  its columns. tables of older runs keep their columns and date type.
+
+  Args:
+    account_name: name of account
+    gsc_property: gsc property
+    drop_ctr: no ctr column in new tables (default: {False})
+  """
+
+  LOOKUP_TABLES = False
+
+  def __init__(self, account_name: str, gsc_property: str, drop_ctr: bool = False):
+    self.path = self.data_path(account_name, gsc_property)
+    self.drop_ctr = drop_ctr
+    self.schemas = {}
+    self.columns = {}
+    self.statements = {}
+    self.con = None
+
+
+  @staticmethod
+  def data_path(account_name, gsc_property):
+    return os.path.join(os.environ['SQLITE_PATH'], account_name,
+                        property_slug(gsc_property)+'.db')
+
+
+  @classmethod
+  def delete(cls, account_name, gsc_property):
+    """delete data of property"""
+    os.remove(cls.data_path(account_name, gsc_property))
+
+
+  def connect(self):
+    os.makedirs(os.path.dirname(self.path), exist_ok=True)
+    con = sqlite3.connect(self.path, isolation_level=None, timeout=60,
+                          check_same_thread=False, cached_statements=512)
+    for pragma in PRAGMAS:
+      con.execute(pragma)
+    if not self.LOOKUP_TABLES and has_lookup_tables(con):
+      con.close() # fact tables of the normalized sink, not readable as rows
+      raise ValueError(f'{self.path} has dim_* tables of the sqlite_normalized sink, '
+                       f'rename it to {self.path[:-len(".db")]}.normalized.db')
+    return con
+
+
+  def open(self):
+    self.con = self.connect()
+    self.con.execute(f'CREATE TABLE IF NOT EXISTS "{LOG_TABLE}" ('
+                     'query_queue_id INTEGER NOT NULL PRIMARY KEY, '
+                     'tbl_name TEXT NOT NULL, date DATE NOT NULL, '
+                     'rows INTEGER NOT NULL, finished BOOLEAN NOT NULL)')
+    if self.schemas: # tables of the run in one transaction
+      self.begin()
+      for tbl_name in self.schemas:
+        self.ensure_table(tbl_name)
+      self.commit()
+
+
+  def close(self):
+    self.con.close()
+
+
+  def declare(self, tables: dict):
+    """tables to create typed on open
+
+    Args:
+      tables: table name → dimensions
+    """
+    self.schemas = dict(tables)
+
+
+  def definition(self, dimensions):
+    """(column, sqlite type) of a table with dimensions"""
+    return [(column, SQLITE_TYPES[kind])
+            for column, kind in schema.columns(dimensions, self.drop_ctr)]
+
+
+  def log(self, tbl_name: str, query_queue_id: int, date_, rows: int,
+          finished: bool):
+    """record item in the open transaction"""
+    self.con.execute(f'INSERT OR REPLACE INTO "{LOG_TABLE}" '
+                     '(query_queue_id, tbl_name, date, rows, finished) '
+                     'VALUES (?, ?, ?, ?, ?)',
+                     (query_queue_id, tbl_name, date_, rows, finished))
+
+
+  def logged(self):
+    """items in the log
+
+    Returns:
+      query_queue_id → dict(rows, finished)
+      dict
+    """
+    if not os.path.exists(self.path):
+      return {}
+    con = self.connect()
+    try:
+      return {row[0]: dict(rows=row[1], finished=bool(row[2]))
+              for row in con.execute('SELECT query_queue_id, rows, finished '
+                                     f'FROM "{LOG_TABLE}"')}
+    except sqlite3.OperationalError: # no log yet
+      return {}
+    finally:
+      con.close()
+
+
+  def begin(self):
+    if not self.con.in_transaction: # wait for the write lock of other processes
+      self.con.execute('BEGIN IMMEDIATE')
+
+
+  def commit(self):
+    if self.con.in_transaction:
+      self.con.execute('COMMIT')
+
+
+  def rollback(self):
+    if self.con.in_transaction:
+      self.con.execute('ROLLBACK')
+      self.columns = {} # tables and columns of the rolled back transaction
+      self.statements = {}
+
+
+  def table_columns(self, tbl_name):
+    """column → declared type of table, empty if it does not exist"""
+    return {r[1]: r[2] for r in self.con.execute(f'PRAGMA table_info("{tbl_name}")')}
+
+
+  def ensure_table(self, tbl_name, row=None):
+    """create table and add missing columns for row
+
+    declared tables are created with their typed columns, others with
+    the columns of their first row.
+    """
+    columns = self.columns.get(tbl_name)
+    if columns is None:
+      columns = self.table_columns(tbl_name)
+      if not columns:
+        if tbl_name in self.schemas:
+          definition = ', '.join(f'"{column}" {type_}' for column, type_
+                                 in self.definition(self.schemas[tbl_name]))
+          self.con.execute(f'CREATE TABLE "{tbl_name}" '
+                           f'(id INTEGER NOT NULL PRIMARY KEY, {definition})')
+        else:
+          self.con.execute(f'CREATE TABLE "{tbl_name}" '
+                           '(id INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT)')
+        columns = self.table_columns(tbl_name)
+      self.columns[tbl_name] = columns
+    for key, value in (row or {}).items():
+      if key not in columns and not (self.drop_ctr and key == 'ctr'):
+        self.con.execute(f'ALTER TABLE "{tbl_name}" '
+                         f'ADD COLUMN "{key}" {column_type(value)}')
+        columns[key] = column_type(value)
+        self.statements.pop(tbl_name, None)
+
+
+  def statement(self, tbl_name):
+    """prepared insert statement over all columns of table
+
+    Returns:
+      sql, columns and whether date is stored as day
+      tuple
+    """
+    statement = self.statements.get(tbl_name)
+    if statement is None:
+      columns = self.columns[tbl_name]
+      keys = tuple(key for key in columns if key != 'id')
+      names = ', '.join(f'"{key}"' for key in keys)
+      values = ', '.join('?' * len(keys))
+      sql = f'INSERT INTO "{tbl_name}" ({names}) VALUES ({values})'
+      statement = (sql, keys, columns.get('date') == 'INTEGER')
+      self.statements[tbl_name] = statement
+    return statement
+
+
+  def write(self, tbl_name: str, rows: List[dict]):
+    if not rows:
+      return
+    self.ensure_table(tbl_name, rows[0])
+    sql, keys, day = self.statement(tbl_name)
+    values = [tuple(row.get(k) for k in keys) for row in rows]
+    if day: # dates of a batch are few
+      i = keys.index('date')
+      days = {key: schema.epoch_day(key) for key in {value[i] for value in values}}
+      values = [value[:i] + (days[value[i]],) + value[i+1:] for value in values]
+    self.con.executemany(sql, values)
+
+
+  def replace(self, tbl_name: str, query_queue_id: int, date_):
+    """delete rows of a refreshed item in the open transaction"""
+    if tbl_name not in self.columns: # table of this run
+      exists = self.con.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' "
+                                "AND name = ?", (tbl_name,)).fetchone()
+      if exists is None:
+        return
+    self.con.execute(f'DELETE FROM "{tbl_name}" WHERE query_queue_id = ?',
+                     (query_queue_id,))
+
+
+  def drop_indices(self, tables: List[str]):
+    con = self.connect()
+    for table in tables:
+      logger.info(f'dropping indices for {table}')
+      con.execute(f'DROP INDEX IF EXISTS "{table}_query_queue_id_idx"')
+      con.execute(f'DROP INDEX IF EXISTS "{table}_date_idx"')
+    con.close()
+
+
+  def create_indices(self, tables: List[str]):
+    con = self.connect()
+    existing = {row[0] for row in
+                con.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    for table in tables:
+      if table not in existing: # no rows fetched
+        continue
+      logger.info(f'creating indices for {table}')
+      con.execute(f'CREATE INDEX IF NOT EXISTS "{table}_query_queue_id_idx" '
+                  f'ON "{table}" (query_queue_id)')
+      con.execute(f'CREATE INDEX IF NOT EXISTS "{table}_date_idx" '
+                  f'ON "{table}" (date)')
+    con.close()
+
+
+class Interner:
+  """value → id mapping of one lookup table with an lru cache
+
+  Args:
+    con: sqlite connection
+    table: lookup table name
+    size: max cached values (default: {500000})
+  """
+
+  def __init__(self, con, table: str, size: int = 500000):
+    self.con = con
+    self.table = table
+    self.size = size
+    self.cache = OrderedDict()
+    con.execute(f'CREATE TABLE IF NOT EXISTS "{table}" ('
+                'id INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT, '
+                'value TEXT NOT NULL UNIQUE)')
+
+
+  def ids(self, values: List[str]):
+    """ids for values, unknown values are inserted
+
+    Returns:
+      value → id
+      dict
+    """
+    result = {}
+    missing = []
+    for value in set(values):
+      id_ = self.cache.get(value)
+      if id_ is None:
+        missing.append(value)
+      else:
+        self.cache.move_to_end(value)
+        result[value] = id_
+    if missing:
+      self.con.executemany(f'INSERT OR IGNORE INTO "{self.table}" (value) VALUES (?)',
+                           [(value,) for value in missing])
+      for i in range(0, len(missing), 500):
+        chunk = missing[i:i+500]
+        placeholders = ', '.join('?' * len(chunk))
+        for id_, value in self.con.execute(f'SELECT id, value FROM "{self.table}" '
+                                           f'WHERE value IN ({placeholders})', chunk):
+          result[value] = id_
+          self.cache[value] = id_
+      while len(self.cache) > self.size:
+        self.cache.popitem(last=False)
+    return result
+
+
+  def clear(self):
+    self.cache.clear()
+
+
+class NormalizedSqliteSink(SqliteSink):
+  """sqlite sink with dimension values in lookup tables
+
+  every dimension value (query, page, country, ...) is stored once in
+  dim_{dimension} (id, value). fact tables keep {dimension}_id, date,
+  query_queue_id and the metrics. the tables have the names of the
+  sqlite sink, so they live in their own file
+  {SQLITE_PATH}/{account_name}/{property_slug}.normalized.db.
+
+  Args:
+    account_name: name of account
+    gsc_property: gsc property
+    drop_ctr: no ctr column in new tables (default: {False})
+  """
+
+  DIMENSIONS = ('country', 'device', 'page', 'query', 'searchAppearance')
+  LOOKUP_TABLES = True
+
+  def __init__(self, account_name: str, gsc_property: str, drop_ctr: bool = False):
+    super().__init__(account_name, gsc_property, drop_ctr)
+    self.interners = {}
+
+
+  @staticmethod
+  def data_path(account_name, gsc_property):
+    return os.path.join(os.environ['SQLITE_PATH'], account_name,
+                        property_slug(gsc_property)+'.normalized.db')
+
+
+  def open(self):
+    super().open()
+    # lookup tables outside of batches, a rollback must not drop them
+    self.interners = {dimension: Interner(self.con, f'dim_{dimension}')
+                      for dimension in self.DIMENSIONS}
+
+
+  def definition(self, dimensions):
+    return [(column+'_id', 'INTEGER') if column in self.DIMENSIONS else (column, type_)
+            for column, type_ in super().definition(dimensions)]
+
+
+  def interner(self, dimension):
+    if dimension not in self.interners:
+      self.interners[dimension] = Interner(self.con, f'dim_{dimension}')
+    return self.interners[dimension]
+
+
+  def write(self, tbl_name: str, rows: List[dict]):
+    if not rows:
+      return
+    dimensions = [key for key in rows[0] if key in self.DIMENSIONS]
+    ids = {dimension: self.interner(dimension).ids([row[dimension] for row in rows])
+           for dimension in dimensions}
+    for row in rows: # rows belong to the writer, encode in place
+      for dimension in dimensions:
+        row[dimension+'_id'] = ids[dimension][row.pop(dimension)]
+    super().write(tbl_name, rows)
+
+
+  def rollback(self):
+    super().rollback()
+    for interner in self.interners.values(): # ids of rolled back values
+      interner.clear()
+
+
+class ParquetSink:
+  """rows into parquet files partitioned by table and date
+
+  layout: {PARQUET_PATH}/{account_name}/{property_slug}/{tbl_name}/date={date}/{query_queue_id}-{n}.parquet
+  rows are buffered in memory and written on commit. files are written
+  to a temporary name and renamed, so readers never see partial files.
+  old files of a refreshed item are removed after its new files are in
+  place. _item_log.jsonl records every item: unfinished before its files
+  are written, finished after, so files of a crashed commit are
+  replaced by the next run.
+
+  Args:
+    account_name: name of account
+    gsc_property: gsc property
+    row_group_size: rows per parquet row group (default: {131072})
+    drop_ctr: no ctr column in the files (default: {False})
+  """
+
+  INTEGER = ('clicks', 'impressions', 'query_queue_id')
+  FLOAT = ('ctr', 'position')
+
+  def __init__(self, account_name: str, gsc_property: str,
+               row_group_size: int = 131072, drop_ctr: bool = False):
+    import pyarrow
+    import pyarrow.parquet
+    self.pa = pyarrow
+    self.pq = pyarrow.parquet
+    self.path = self.data_path(account_name, gsc_property)
+    self.row_group_size = row_group_size
+    self.drop_ctr = drop_ctr
+    self.buffers = {}
+    self.parts = {}
+    self.replaced = set()
+    self.entries = []
+
+
+  @staticmethod
+  def account_path(account_name):
+    return os.path.join(os.environ.get('PARQUET_PATH',
+                                       os.path.join(os.environ['SQLITE_PATH'],
+                                                    'parquet')),
+                        account_name)
+
+
+  @classmethod
+  def data_path(cls, account_name, gsc_property):
+    return os.path.join(cls.account_path(account_name), property_slug(gsc_property))
+
+
+  @classmethod
+  def delete(cls, account_name, gsc_property):
+    """delete data of property"""
+    path = cls.data_path(account_name, gsc_property)
+    if not os.path.isdir(path):
+      raise FileNotFoundError(path)
+    shutil.rmtree(path)
+
+
+  def open(self):
+    os.makedirs(self.path, exist_ok=True)
+
+
+  def close(self):
+    pass
+
+
+  def begin(self):
+    pass
+
+
+  def declare(self, tables: dict):
+    pass # files have the columns of their rows
+
+
+  def schema(self, keys):
+    fields = []
+    for key in keys:
+      if key in self.INTEGER:
+        fields.append(self.pa.field(key, self.pa.int64()))
+      elif key in self.FLOAT:
+        fields.append(self.pa.field(key, self.pa.float64()))
+      else:
+        fields.append(self.pa.field(key, self.pa.string()))
+    return self.pa.schema(fields)
+
+
+  def write(self, tbl_name: str, rows: List[dict]):
+    for row in rows:
+      key = (tbl_name, str(row['date']), row['query_queue_id'])
+      self.buffers.setdefault(key, []).append(row)
+
+
+  def replace(self, tbl_name: str, query_queue_id: int, date_):
+    self.replaced.add((tbl_name, str(date_), query_queue_id))
+
+
+  def log(self, tbl_name: str, query_queue_id: int, date_, rows: int,
+          finished: bool):
+    self.entries.append(dict(query_queue_id=query_queue_id, tbl_name=tbl_name,
+                             date=str(date_), rows=rows, finished=finished))
+
+
+  def append_log(self, entries):
+    with open(os.path.join(self.path, LOG_TABLE+'.jsonl'), 'a') as f:
+      for entry in entries:
+        f.write(json.dumps(entry)+'\n')
+      f.flush()
+      os.fsync(f.fileno())
+
+
+  def logged(self):
+    """items in the log, last entry of an item wins
+
+    Returns:
+      query_queue_id → dict(rows, finished)
+      dict
+    """
+    result = {}
+    try:
+      with open(os.path.join(self.path, LOG_TABLE+'.jsonl')) as f:
+        for line in f:
+          try:
+            entry = json.loads(line)
+          except ValueError: # torn last line
+            continue
+          result[entry['query_queue_id']] = dict(rows=entry['rows'],
+                                                 finished=entry['finished'])
+    except FileNotFoundError:
+      pass
+    return result
+
+
+  def files(self, tbl_name, date_, query_queue_id):
+    directory = os.path.join(self.path, tbl_name, f'date={date_}')
+    prefix = f'{query_queue_id}-'
+    if not os.path.isdir(directory):
+      return []
+    return [os.path.join(directory, name) for name in os.listdir(directory)
+            if name.startswith(prefix) and name.endswith('.parquet')]
+
+
+  def commit(self):
+    if not self.entries:
+      return
+    # unfinished first: files of a crashed commit belong to a logged item
+    self.append_log([dict(entry, rows=0, finished=False) for entry in self.entries])
+    old_files = {key: self.files(*key) for key in self.replaced}
+    for (tbl_name, date_, query_queue_id), rows in self.buffers.items():
+      directory = os.path.join(self.path, tbl_name, f'date={date_}')
+      os.makedirs(directory, exist_ok=True)
+      old = old_files.get((tbl_name, date_, query_queue_id), [])
+      n = self.parts.get(query_queue_id, 0)
+      if old: # new files next to the old ones till they are written
+        n = max(n, max(int(f.rsplit('-', 1)[1].split('.')[0]) for f in old) + 1)
+      self.parts[query_queue_id] = n + 1
+      path = os.path.join(directory, f'{query_queue_id}-{n:04d}.parquet')
+      # date is the hive partition key, not stored in the file
+      schema = self.schema([key for key in rows[0] if key != 'date'
+                            and not (self.drop_ctr and key == 'ctr')])
+      arrays = [self.pa.array([row[field.name] for row in rows]).cast(field.type)
+                for field in schema]
+      table = self.pa.Table.from_arrays(arrays, schema=schema)
+      self.pq.write_table(table, path+'.tmp', row_group_size=self.row_group_size)
+      os.replace(path+'.tmp', path)
+    for files in old_files.values():
+      for f in files:
+        os.remove(f)
+    self.append_log(self.entries)
+    self.buffers = {}
+    self.replaced = set()
+    self.entries = []
+
+
+  def rollback(self):
+    self.buffers = {}
+    self.replaced = set()
+    self.entries = []
+
+
+  def drop_indices(self, tables: List[str]):
+    pass
+
+
+  def create_indices(self, tables: List[str]):
+    pass
+
+
+class DuckDbSink:
+  """rows into one duckdb table per job in {SQLITE_PATH}/{account_name}/{property_slug}.duckdb
+
+  rows are buffered per table and loaded on commit as one arrow table
+  per table, together with deletes of replaced items and the _item_log
+  entries in one transaction. tables are named like the sqlite tables,
+  declared tables are created typed on open. a duckdb file is opened by
+  one process only, so --claim with several processes needs a sqlite
+  or parquet sink.
+
+  Args:
+    account_name: name of account
+    gsc_property: gsc property
+    drop_ctr: no ctr column in new tables (default: {False})
+  """
+
+  INTEGER = ('clicks', 'impressions', 'query_queue_id')
+  FLOAT = ('ctr', 'position')
+
+  def __init__(self, account_name: str, gsc_property: str, drop_ctr: bool = False):
+    import duckdb
+    import pyarrow
+    self.duckdb = duckdb
+    self.pa = pyarrow
+    self.path = self.data_path(account_name, gsc_property)
+    self.drop_ctr = drop_ctr
+    self.schemas = {}
+    self.columns = {}
+    self.con = None
+    self.in_transaction = False
+    self.buffers = {}
+    self.entries = []
+
+
+  @staticmethod
+  def data_path(account_name, gsc_property):
+    return os.path.join(os.environ['SQLITE_PATH'], account_name,
+                        property_slug(gsc_property)+'.duckdb')
+
+
+  @classmethod
+  def delete(cls, account_name, gsc_property):
+    """delete data of property"""
+    os.remove(cls.data_path(account_name, gsc_property))
+
+
+  def open(self):
+    os.makedirs(os.path.dirname(self.path), exist_ok=True)
+    self.con = self.duckdb.connect(self.path)
+    self.con.execute(f'CREATE TABLE IF NOT EXISTS "{LOG_TABLE}" ('
+                     'query_queue_id BIGINT PRIMARY KEY, '
+                     'tbl_name VARCHAR NOT NULL, date DATE NOT NULL, '
+                     'rows BIGINT NOT NULL, finished BOOLEAN NOT NULL)')
+    for tbl_name in self.schemas:
+      self.ensure_table(tbl_name, [])
+
+
+  def close(self):
+    self.con.close()
+
+
+  def begin(self):
+    pass
+
+
+  def declare(self, tables: dict):
+    """tables to create typed on open
+
+    Args:
+      tables: table name → dimensions
+    """
+    self.schemas = dict(tables)
+
+
+  def column_type(self, key):
+    if key in self.INTEGER:
+      return 'BIGINT', self.pa.int64()
+    if key in self.FLOAT:
+      return 'DOUBLE', self.pa.float64()
+    if key == 'date':
+      return 'DATE', self.pa.string() # cast by duckdb on insert
+    return 'VARCHAR', self.pa.string()
+
+
+  def ensure_table(self, tbl_name, keys):
+    """create table and add missing columns for keys"""
+    columns = self.columns.get(tbl_name)
+    if columns is None:
+      columns = {row[0] for row in self.con.execute(
+        'SELECT column_name FROM information_schema.columns WHERE table_name = ?',
+        [tbl_name]).fetchall()}
+      if not columns:
+        if tbl_name in self.schemas: # typed columns first
+          keys = list(dict.fromkeys([column for column, kind in
+                                     schema.columns(self.schemas[tbl_name], self.drop_ctr)]
+                                    + list(keys)))
+        definition = ', '.join(f'"{key}" {self.column_type(key)[0]}' for key in keys)
+        self.con.execute(f'CREATE TABLE "{tbl_name}" ({definition})')
+        columns = set(keys)
+      self.columns[tbl_name] = columns
+    for key in keys:
+      if key not in columns:
+        self.con.execute(f'ALTER TABLE "{tbl_name}" '
+                         f'ADD COLUMN "{key}" {self.column_type(key)[0]}')
+        columns.add(key)
+
+
+  def write(self, tbl_name: str, rows: List[dict]):
+    if rows:
+      self.buffers.setdefault(tbl_name, []).extend(rows)
+
+
+  def replace(self, tbl_name: str, query_queue_id: int, date_):
+    """drop rows of item from the buffer and delete its stored rows on commit"""
+    rows = self.buffers.get(tbl_name)
+    if rows: # earlier attempt in the same batch
+      self.buffers[tbl_name] = [row for row in rows
+                                if row['query_queue_id'] != query_queue_id]
+    self.entries.append(('replace', tbl_name, query_queue_id))
+
+
+  def log(self, tbl_name: str, query_queue_id: int, date_, rows: int,
+          finished: bool):
+    self.entries.append(('log', tbl_name, query_queue_id, str(date_), rows, finished))
+
+
+  def logged(self):
+    """items in the log
+
+    Returns:
+      query_queue_id → dict(rows, finished)
+      dict
+    """
+    if not os.path.exists(self.path):
+      return {}
+    con = self.duckdb.connect(self.path)
+    try:
+      return {row[0]: dict(rows=row[1], finished=bool(row[2]))
+              for row in con.execute('SELECT query_queue_id, rows, finished '
+                                     f'FROM "{LOG_TABLE}"').fetchall()}
+    except self.duckdb.CatalogException: # no log yet
+      return {}
+    finally:
+      con.close()
+
+
+  def load(self, tbl_name, rows):
+    """insert rows through an arrow table"""
+    keys = [key for key in rows[0] if not (self.drop_ctr and key == 'ctr')]
+    self.ensure_table(tbl_name, keys)
+    table = self.pa.Table.from_arrays(
+      [self.pa.array([row.get(key) for row in rows]).cast(self.column_type(key)[1])
+       for key in keys], names=keys)
+    columns = ', '.join(f'"{key}"' for key in keys)
+    self.con.register('_rows', table)
+    try:
+      self.con.execute(f'INSERT INTO "{tbl_name}" ({columns}) SELECT {columns} FROM _rows')
+    finally:
+      self.con.unregister('_rows')
+
+
+  def commit(self):
+    if not self.entries and not self.buffers:
+      return
+    self.con.execute('BEGIN TRANSACTION')
+    self.in_transaction = True
+    for entry in self.entries:
+      if entry[0] == 'replace' and self.table_exists(entry[1]):
+        self.con.execute(f'DELETE FROM "{entry[1]}" WHERE query_queue_id = ?',
+                         [entry[2]])
+    for tbl_name, rows in self.buffers.items():
+      if rows:
+        self.load(tbl_name, rows)
+    logs = [entry[2:] + (entry[1],) for entry in self.entries if entry[0] == 'log']
+    if logs:
+      self.con.executemany(f'INSERT OR REPLACE INTO "{LOG_TABLE}" '
+                           '(query_queue_id, date, rows, finished, tbl_name) '
+                           'VALUES (?, ?, ?, ?, ?)', logs)
+    self.con.execute('COMMIT')
+    self.in_transaction = False
+    self.buffers = {}
+    self.entries = []
+
+
+  def table_exists(self, tbl_name):
+    if tbl_name in self.columns: # table of this run
+      return True
+    return self.con.execute('SELECT 1 FROM information_schema.tables '
+                            'WHERE table_name = ?', [tbl_name]).fetchone() is not None
+
+
+  def rollback(self):
+    if self.in_transaction:
+      self.con.execute('ROLLBACK')
+      self.in_transaction = False
+      self.columns = {} # tables and columns of the rolled back transaction
+    self.buffers = {}
+    self.entries = []
+
+
+  def drop_indices(self, tables: List[str]):
+    pass
+
+
+  def create_indices(self, tables: List[str]):
+    pass
+
+
+SINKS = {'sqlite': SqliteSink,
+         'sqlite_normalized': NormalizedSqliteSink,
+         'parquet': ParquetSink,
+         'duckdb': DuckDbSink}
+
+
+def account_files(account_name: str):
+  """data files of an account from before per property files
+
+  an account named like the root db has no account file, it is the root db.
+  """
+  root = os.path.join(os.environ['SQLITE_PATH'], os.environ['ROOT_DB'])
+  paths = [os.path.join(os.environ['SQLITE_PATH'], account_name+'.db'),
+           os.path.join(os.environ['SQLITE_PATH'], account_name+'.duckdb'),
+           os.path.join(ParquetSink.account_path(account_name), LOG_TABLE+'.jsonl')]
+  return [path for path in paths if os.path.exists(path)
+          and not (os.path.exists(root) and os.path.samefile(path, root))]
+
+
+def get_sink(name: str, account_name: str, gsc_property: str, drop_ctr: bool = False):
+  """sink by name (sqlite, sqlite_normalized, parquet, duckdb) for a property"""
+  old = account_files(account_name)
+  if old:
+    logger.warning(f'{account_name} has data in account files {old} - '
+                   'split them per property with python migrate.py')
+  return SINKS[name](account_name, gsc_property, drop_ctr=drop_ctr)
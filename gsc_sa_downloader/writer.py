@@ -0,0 +1,189 @@
+#       _                         __    __           __   __      __         __
+#      (_)___  ____  ____  __  __/ /_  / /___ ______/ /__/ /___ _/ /_  ___  / /
+#     / / __ \/ __ \/ __ \/ / / / __ \/ / __ `/ ___/ //_/ / __ `/ __ \/ _ \/ /
+#    / / /_/ / / / / / / / /_/ / /_/ / / /_/ / /__/ ,< / / /_/ / /_/ /  __/ /
+# __/ /\____/_/ /_/_/ /_/\__, /_.___/_/\__,_/\___/_/|_/_/\__,_/_.___/\___/_/
+#/___/                  /____/
+"""
+author: Johannes Kunze
+twitter: @jonnyblacklabel
+web: http://www.jonnyblacklabel.de/
+github: https://github.com/Jonnyblacklabel
+"""
+
+from queue import Queue, Empty
+from loguru import logger
+import metrics
+import time
+import db
+
+
+class DbWriter:
+  """batched writer for a sink
+
+  blocks on db_queue and writes reports in one transaction until
+  batch_rows rows are written or batch_ms milliseconds passed since the
+  transaction started. query queue items are marked finished and
+  task_done is called only after the transaction is committed.
+  streamed pages (final=False) are written without finishing the item,
+  the last message of an item finishes it.
+
+  writes are idempotent: every message is recorded in the item log of
+  the sink within the same transaction. the first message of a fetch
+  deletes the rows of an item that was written before (logged, earlier
+  attempt or refreshed), so a crash or retry never leaves duplicates.
+  lag is the time from queueing a message till its commit.
+
+  a failed write or commit rolls back the whole batch. its items are
+  in failed and never finished by a later message of the same fetch,
+  their next fetch replaces the rows.
+
+  Args:
+    sink: sink for rows (see sinks.py)
+    db_queue: queue with report items, None stops the writer
+    known: ids of items with rows in the sink (default: {None})
+    batch_rows: commit after n rows (default: {50000})
+    batch_ms: commit after n milliseconds (default: {2000})
+  """
+
+  def __init__(self, sink, db_queue: Queue, known=None,
+               batch_rows: int = 50000, batch_ms: int = 2000):
+    self.sink = sink
+    self.db_queue = db_queue
+    self.known = set(known or ())
+    self.failed = set()
+    self.batch_rows = batch_rows
+    self.batch_ms = batch_ms
+    self.pending = []
+    self.pending_rows = 0
+    self.deadline = None
+    self.lag_max = 0
+    self.lag_sum = 0
+    self.lag_count = 0
+    self.batch_started = None
+    self.label = type(sink).__name__
+
+
+  def mean_lag(self):
+    """mean seconds from queueing a message till its commit"""
+    return self.lag_sum / max(self.lag_count, 1)
+
+
+  def write(self, item):
+    self.sink.begin()
+    if self.deadline is None:
+      self.batch_started = time.monotonic()
+      self.deadline = self.batch_started + self.batch_ms / 1000
+    query_queue_id = item['query_queue_id']
+    if item.get('first', True):
+      if item.get('replace') or query_queue_id in self.known: # rows of before
+        self.sink.replace(item['tbl_name'], query_queue_id, item['date'])
+      self.known.add(query_queue_id)
+    self.sink.write(item['tbl_name'], item['report'])
+    final = item.get('final', True)
+    self.sink.log(item['tbl_name'], query_queue_id, item['date'],
+                  item['report_len'] if final else 0, final)
+    self.pending.append(item)
+    self.pending_rows += len(item['report'])
+
+
+  def skip(self, item):
+    """True for messages of an item with lost rows till its next fetch"""
+    query_queue_id = item['query_queue_id']
+    if query_queue_id not in self.failed:
+      return False
+    if item.get('first', True): # next fetch replaces the rows
+      self.failed.discard(query_queue_id)
+      return False
+    return True
+
+
+  def fail(self, items):
+    """roll back the batch, its items have to be fetched again"""
+    metrics.WRITER_ERRORS.inc(sink=self.label)
+    self.sink.rollback()
+    ids = {item['query_queue_id'] for item in items}
+    self.failed.update(ids)
+    self.known.update(ids) # committed pages of before are replaced
+    logger.warning(f'[{len(ids)}] items lost rows, they are fetched again')
+
+
+  def commit(self):
+    if not self.pending:
+      self.deadline = None
+      return
+    start = time.time()
+    try:
+      self.sink.commit()
+    except Exception as e:
+      logger.exception(e)
+      self.fail(self.pending)
+    else:
+      try:
+        db.update_query_queue_items_status([(item['query_queue_id'],
+                                             item['attempts']+1,
+                                             True,
+                                             item['report_len'],
+                                             item['elapsed'],
+                                             item['hits'],
+                                             item['rps'])
+                                            for item in self.pending
+                                            if item.get('final', True)])
+      except Exception as e: # rows are committed, reconcile finishes the items on the next run
+        metrics.WRITER_ERRORS.inc(sink=self.label)
+        logger.exception(f'status of [{len(self.pending)}] committed items not updated - {e}')
+      now = time.monotonic()
+      for item in self.pending:
+        lag = now - item.get('queued', now)
+        self.lag_max = max(self.lag_max, lag)
+        self.lag_sum += lag
+        self.lag_count += 1
+        metrics.WRITER_LAG.observe(lag, sink=self.label)
+      metrics.COMMIT_SECONDS.observe(time.time() - start, sink=self.label)
+      metrics.BATCH_SECONDS.observe(now - self.batch_started, sink=self.label)
+      metrics.BATCH_ROWS.observe(self.pending_rows, sink=self.label)
+      logger.debug(f'committed [{len(self.pending)}] items - [{self.pending_rows}] rows - [{round(time.time()-start,3)}] seconds')
+    finally:
+      for item in self.pending:
+        self.db_queue.task_done()
+      self.pending = []
+      self.pending_rows = 0
+      self.deadline = None
+
+
+  def run(self):
+    self.sink.open()
+    try:
+      while True:
+        timeout = None
+        if self.deadline is not None:
+          timeout = max(0, self.deadline - time.monotonic())
+        try:
+          item = self.db_queue.get(timeout=timeout)
+        except Empty: # batch_ms passed
+          self.commit()
+          continue
+        if item is None:
+          self.commit()
+          self.db_queue.task_done()
+          break
+        if self.skip(item):
+          self.db_queue.task_done()
+          continue
+        try:
+          self.write(item)
+        except Exception as e: # partial rows of item are in the batch
+          logger.exception(e)
+          self.pending.append(item)
+          self.fail(self.pending)
+          for item_ in self.pending:
+            self.db_queue.task_done()
+          self.pending = []
+          self.pending_rows = 0
+          self.deadline = None
+          continue
+        if self.pending_rows >= self.batch_rows \
+        or time.monotonic() >= self.deadline:
+          self.commit()
+    finally:
+      self.sink.close()